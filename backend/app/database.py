@@ -1,35 +1,79 @@
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.pool import StaticPool
-from sqlalchemy import text
+from sqlalchemy.engine import URL, make_url
+from sqlalchemy import event
 
 from app.config import settings
 
-# SQLite 配置
-engine = create_async_engine(
-    settings.database_url,
-    echo=False,
-    connect_args={
-        "check_same_thread": False,
-        "timeout": 30
-    },
-    poolclass=StaticPool
-)
+# 支持 SQLite（默认，单进程）和 PostgreSQL（postgresql+asyncpg://，可多进程部署）
+database_url = make_url(settings.database_url)
+IS_SQLITE = database_url.get_backend_name() == "sqlite"
 
+if IS_SQLITE:
+    from sqlalchemy.dialects.sqlite import insert as upsert_insert
+else:
+    from sqlalchemy.dialects.postgresql import insert as upsert_insert
+
+
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    """每个 SQLite 连接建立时设置 pragma"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA busy_timeout=30000")
+    cursor.execute(f"PRAGMA synchronous={settings.sqlite_synchronous}")
+    cursor.execute(f"PRAGMA cache_size={int(settings.sqlite_cache_size)}")
+    cursor.execute(f"PRAGMA mmap_size={int(settings.sqlite_mmap_size)}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+def build_engine(url: URL) -> AsyncEngine:
+    """按数据库类型创建引擎（测试中也用它为临时数据库建引擎）"""
+    if url.get_backend_name() == "sqlite":
+        # SQLite 配置：文件数据库每个会话使用独立的连接（WAL 下读写互不阻塞，写入靠 busy_timeout 排队），
+        # 共享一个连接时，一个会话的回滚会撤销其他会话还没提交的写入；内存数据库只能共享同一个连接
+        in_memory = url.database in (None, "", ":memory:")
+        sqlite_engine = create_async_engine(
+            url,
+            echo=False,
+            connect_args={
+                "check_same_thread": False,
+                "timeout": 30
+            },
+            **({"poolclass": StaticPool} if in_memory else {
+                "pool_size": settings.db_pool_size,
+                "max_overflow": settings.db_max_overflow,
+                "pool_timeout": settings.db_pool_timeout
+            })
+        )
+        event.listen(sqlite_engine.sync_engine, "connect", _apply_sqlite_pragmas)
+        return sqlite_engine
+    return create_async_engine(
+        url,
+        echo=False,
+        pool_size=settings.db_pool_size,
+        max_overflow=settings.db_max_overflow,
+        pool_timeout=settings.db_pool_timeout,
+        pool_recycle=settings.db_pool_recycle,
+        pool_pre_ping=settings.db_pool_pre_ping
+    )
+
+
+engine = build_engine(database_url)
 async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
 Base = declarative_base()
 
 
-async def init_db():
-    """初始化数据库"""
-    async with engine.begin() as conn:
+async def init_db(target: AsyncEngine = None):
+    """初始化数据库（默认初始化应用的数据库）"""
+    target = target or engine
+    async with target.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
-    
-    # 启用 WAL 模式
-    async with engine.begin() as conn:
-        await conn.execute(text("PRAGMA journal_mode=WAL"))
-        await conn.execute(text("PRAGMA busy_timeout=30000"))
+
+    from app.migrations import run_migrations
+    await run_migrations(target)
 
 
 async def get_db():
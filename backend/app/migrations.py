@@ -0,0 +1,82 @@
+from datetime import datetime
+from typing import Callable, List, Tuple
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, func, insert, inspect, select, text
+
+# 数据库结构迁移
+#
+# create_all 只会创建缺少的表，不会给已有的表加索引或字段。已部署的数据库
+# 在启动时按版本号依次执行这里的迁移，schema_version 表记录已执行到的版本。
+# 每个迁移都应该是幂等的：新数据库由 create_all 建好后同样会执行一遍。
+
+_metadata = MetaData()
+
+schema_version = Table(
+    "schema_version", _metadata,
+    Column("version", Integer, primary_key=True),
+    Column("description", String(200)),
+    Column("applied_at", DateTime, default=datetime.utcnow),
+)
+
+
+def _create_indexes(conn, table, *names: str):
+    for index in table.indexes:
+        if index.name in names:
+            index.create(conn, checkfirst=True)
+
+
+def _hot_query_indexes(conn):
+    from app.models.user import Token, UsageLog
+
+    _create_indexes(conn, Token.__table__, "ix_tokens_user_active", "ix_tokens_public_pool")
+    _create_indexes(conn, UsageLog.__table__, "ix_usage_logs_user_created", "ix_usage_logs_created")
+
+
+def _usage_log_token_set_null(conn):
+    # SQLite 不能修改已有的外键（默认也不检查外键），新建的表由 create_all 带上 ON DELETE SET NULL
+    if conn.dialect.name != "postgresql":
+        return
+    for foreign_key in inspect(conn).get_foreign_keys("usage_logs"):
+        if foreign_key["constrained_columns"] != ["token_id"]:
+            continue
+        if ((foreign_key.get("options") or {}).get("ondelete") or "").upper() == "SET NULL":
+            return
+        conn.execute(text(f'ALTER TABLE usage_logs DROP CONSTRAINT "{foreign_key["name"]}"'))
+    conn.execute(text(
+        "ALTER TABLE usage_logs ADD CONSTRAINT usage_logs_token_id_fkey "
+        "FOREIGN KEY (token_id) REFERENCES tokens (id) ON DELETE SET NULL"
+    ))
+
+
+# (版本号, 说明, 迁移函数)，版本号递增，已发布的迁移不要修改
+MIGRATIONS: List[Tuple[int, str, Callable]] = [
+    (1, "tokens / usage_logs 常用查询的复合索引", _hot_query_indexes),
+    (2, "删除 token 时 usage_logs.token_id 置空", _usage_log_token_set_null),
+]
+
+
+def _run(conn) -> List[int]:
+    if conn.dialect.name == "postgresql":
+        # 多个进程同时启动时只让一个执行迁移
+        conn.execute(text("SELECT pg_advisory_xact_lock(7023415)"))
+    schema_version.create(conn, checkfirst=True)
+    current = conn.execute(select(func.max(schema_version.c.version))).scalar() or 0
+
+    applied = []
+    for version, description, migrate in MIGRATIONS:
+        if version <= current:
+            continue
+        migrate(conn)
+        conn.execute(insert(schema_version).values(
+            version=version, description=description, applied_at=datetime.utcnow()
+        ))
+        applied.append(version)
+    return applied
+
+
+async def run_migrations(engine):
+    """执行未执行过的迁移"""
+    async with engine.begin() as conn:
+        applied = await conn.run_sync(_run)
+    for version in applied:
+        print(f"[Migration] 已执行迁移 #{version}", flush=True)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text
+from sqlalchemy import Column, Integer, String, Boolean, Date, DateTime, ForeignKey, Index, Text, text
 from sqlalchemy.orm import relationship
 from datetime import datetime
 
@@ -20,11 +20,22 @@ class User(Base):
     # 关联
     tokens = relationship("Token", back_populates="user", cascade="all, delete-orphan")
     usage_logs = relationship("UsageLog", back_populates="user", cascade="all, delete-orphan")
+    api_keys = relationship("ApiKey", back_populates="user", cascade="all, delete-orphan")
 
 
 class Token(Base):
     """Antigravity Token"""
     __tablename__ = "tokens"
+    __table_args__ = (
+        # 用户的 token 列表
+        Index("ix_tokens_user_active", "user_id", "is_active"),
+        # 公共池统计（只索引公共 token）
+        Index(
+            "ix_tokens_public_pool", "is_active", "supports_claude", "supports_gemini",
+            sqlite_where=text("is_public = 1"),
+            postgresql_where=text("is_public")
+        ),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
@@ -58,10 +69,15 @@ class Token(Base):
 class UsageLog(Base):
     """使用日志"""
     __tablename__ = "usage_logs"
+    __table_args__ = (
+        Index("ix_usage_logs_user_created", "user_id", "created_at"),
+        Index("ix_usage_logs_created", "created_at"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
-    token_id = Column(Integer, ForeignKey("tokens.id"), nullable=True)
+    # 删除 token 时保留使用日志，只清空 token_id
+    token_id = Column(Integer, ForeignKey("tokens.id", ondelete="SET NULL"), nullable=True)
     
     model = Column(String(100), nullable=True)
     success = Column(Boolean, default=True)
@@ -73,6 +89,33 @@ class UsageLog(Base):
     user = relationship("User", back_populates="usage_logs")
 
 
+class ApiKey(Base):
+    """API Key（只保存 SHA-256 摘要）"""
+    __tablename__ = "api_keys"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    
+    name = Column(String(100), nullable=True)
+    key_hash = Column(String(64), unique=True, nullable=False)  # sha256(key) 十六进制
+    prefix = Column(String(16), nullable=False)  # 明文前几位，用于在列表中辨认
+    
+    created_at = Column(DateTime, default=datetime.utcnow)
+    revoked_at = Column(DateTime, nullable=True, index=True)
+    
+    # 关联
+    user = relationship("User", back_populates="api_keys")
+
+
+class QuotaCounter(Base):
+    """每个用户每天的请求计数（配额检查用）"""
+    __tablename__ = "quota_counters"
+    
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    day = Column(Date, primary_key=True)  # UTC 日期
+    count = Column(Integer, default=0, nullable=False)
+
+
 class SystemConfig(Base):
     """系统配置"""
     __tablename__ = "system_config"
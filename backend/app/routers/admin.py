@@ -0,0 +1,47 @@
+from fastapi import APIRouter, Depends, HTTPException
+
+from app.models.user import User
+from app.services.auth import get_current_admin
+from app.services.cooldown import cooldown_queue
+from app.services.admission import admission_scheduler
+from app.services.reencrypt import reencrypt_job
+
+router = APIRouter(prefix="/api/admin", tags=["管理"])
+
+
+@router.get("/cooldowns")
+async def list_cooldowns(admin: User = Depends(get_current_admin)):
+    """获取当前处于限流冷却中的 Token"""
+    items = cooldown_queue.snapshot()
+    return {"total": len(items), "items": items}
+
+
+@router.delete("/cooldowns/{token_id}")
+async def release_cooldown(
+    token_id: int,
+    model: str = None,
+    admin: User = Depends(get_current_admin)
+):
+    """提前解除 Token 的冷却"""
+    cooldown_queue.release(token_id, model)
+    return {"message": "已解除冷却"}
+
+
+@router.get("/admission")
+async def admission_status(admin: User = Depends(get_current_admin)):
+    """获取上游调用准入队列状态"""
+    return admission_scheduler.snapshot()
+
+
+@router.post("/reencrypt")
+async def start_reencrypt(admin: User = Depends(get_current_admin)):
+    """用当前主密钥重新加密所有 Token（后台执行）"""
+    if not reencrypt_job.start():
+        raise HTTPException(status_code=409, detail="重新加密任务正在进行中")
+    return reencrypt_job.status()
+
+
+@router.get("/reencrypt")
+async def reencrypt_status(admin: User = Depends(get_current_admin)):
+    """获取重新加密任务的进度"""
+    return reencrypt_job.status()
@@ -1,16 +1,20 @@
 from fastapi import APIRouter, Depends, HTTPException, Form
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, update
 from datetime import datetime
 
 from app.database import get_db
-from app.models.user import User, Token
+from app.models.user import User, Token, ApiKey, UsageLog
 from app.services.auth import (
-    get_password_hash, verify_password, create_access_token,
+    get_password_hash_async, verify_password_async, create_access_token,
     get_current_user
 )
 from app.services.crypto import encrypt_token, decrypt_token
-from app.services.token_pool import TokenPool
+from app.services.token_pool import TokenPool, credential_cache
+from app.services.auth_cache import auth_cache
+from app.services.api_keys import generate_api_key, api_key_cache_key
+from app.services.token_index import token_index
+from app.services.scheduler import token_scheduler
 from app.config import settings
 
 router = APIRouter(prefix="/api/auth", tags=["认证"])
@@ -34,7 +38,7 @@ async def register(
     # 创建用户
     user = User(
         username=username,
-        password_hash=get_password_hash(password),
+        password_hash=await get_password_hash_async(password),
         daily_quota=settings.default_daily_quota
     )
     db.add(user)
@@ -54,13 +58,19 @@ async def login(
     result = await db.execute(select(User).where(User.username == username))
     user = result.scalar_one_or_none()
     
-    if not user or not verify_password(password, user.password_hash):
+    valid, new_hash = False, None
+    if user:
+        valid, new_hash = await verify_password_async(password, user.password_hash)
+    if not valid:
         raise HTTPException(status_code=401, detail="用户名或密码错误")
     
     if not user.is_active:
         raise HTTPException(status_code=401, detail="账号已被禁用")
     
     user.last_login = datetime.utcnow()
+    # 哈希参数调整过时，顺便按新参数重新保存
+    if new_hash:
+        user.password_hash = new_hash
     await db.commit()
     
     token = create_access_token({"sub": username})
@@ -94,6 +104,64 @@ async def get_me(user: User = Depends(get_current_user), db: AsyncSession = Depe
     }
 
 
+@router.get("/api-keys")
+async def list_api_keys(user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    """获取我的 API Key 列表"""
+    result = await db.execute(
+        select(ApiKey).where(ApiKey.user_id == user.id).order_by(ApiKey.created_at.desc())
+    )
+    return [{
+        "id": k.id,
+        "name": k.name,
+        "prefix": k.prefix,
+        "created_at": k.created_at.isoformat() if k.created_at else None,
+        "revoked_at": k.revoked_at.isoformat() if k.revoked_at else None
+    } for k in result.scalars().all()]
+
+
+@router.post("/api-keys")
+async def create_api_key(
+    name: str = Form(None),
+    user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """创建 API Key（明文只在这里返回一次）"""
+    key, key_hash = generate_api_key()
+    api_key = ApiKey(user_id=user.id, name=name, key_hash=key_hash, prefix=key[:10])
+    db.add(api_key)
+    await db.commit()
+    
+    return {
+        "id": api_key.id,
+        "name": api_key.name,
+        "key": key,
+        "prefix": api_key.prefix,
+        "created_at": api_key.created_at.isoformat(),
+        "message": "请妥善保存，API Key 只显示这一次"
+    }
+
+
+@router.delete("/api-keys/{key_id}")
+async def revoke_api_key(
+    key_id: int,
+    user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """吊销 API Key"""
+    result = await db.execute(
+        select(ApiKey).where(ApiKey.id == key_id, ApiKey.user_id == user.id)
+    )
+    api_key = result.scalar_one_or_none()
+    if not api_key:
+        raise HTTPException(status_code=404, detail="API Key 不存在")
+    
+    if api_key.revoked_at is None:
+        api_key.revoked_at = datetime.utcnow()
+        await db.commit()
+    auth_cache.invalidate(api_key_cache_key(api_key.key_hash))
+    return {"message": "已吊销"}
+
+
 @router.get("/tokens")
 async def list_my_tokens(user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
     """获取我的 Token 列表"""
@@ -152,6 +220,8 @@ async def upload_token(
         print(f"[Token上传] 用户 {user.username} 捐赠 Token，获得 {reward} 额度", flush=True)
     
     await db.commit()
+    token_index.upsert(new_token)
+    auth_cache.invalidate_user(user.id)
     
     return {
         "message": "Token 上传成功",
@@ -195,6 +265,11 @@ async def update_token(
         token.is_active = is_active
     
     await db.commit()
+    token_index.upsert(token)
+    if not token.is_active:
+        token_scheduler.forget(token_id)
+    credential_cache.invalidate(token_id)
+    auth_cache.invalidate_user(user.id)
     return {"message": "更新成功"}
 
 
@@ -218,6 +293,12 @@ async def delete_token(
         if user.daily_quota - settings.default_daily_quota >= deduct:
             user.daily_quota = max(settings.default_daily_quota, user.daily_quota - deduct)
     
+    # 保留使用日志；SQLite 默认不检查外键，这里显式置空，避免 token id 被复用后记到新 token 上
+    await db.execute(update(UsageLog).where(UsageLog.token_id == token_id).values(token_id=None))
     await db.delete(token)
     await db.commit()
+    token_index.remove(token_id)
+    token_scheduler.forget(token_id)
+    credential_cache.invalidate(token_id)
+    auth_cache.invalidate_user(user.id)
     return {"message": "删除成功"}
@@ -12,6 +12,8 @@ from app.database import get_db
 from app.models.user import User, Token
 from app.services.auth import get_current_user, get_current_admin
 from app.services.crypto import encrypt_token
+from app.services.token_index import token_index
+from app.services.auth_cache import auth_cache
 from app.config import settings
 
 router = APIRouter(prefix="/api/oauth", tags=["OAuth认证"])
@@ -212,6 +214,8 @@ async def oauth_callback(
                 print(f"[OAuth] 用户 {user.username} 获取凭证 {email}，获得 {reward} 额度", flush=True)
             
             await db.commit()
+            token_index.upsert(new_token)
+            auth_cache.invalidate_user(user.id)
             
             return {
                 "message": "Token 获取成功",
@@ -300,6 +304,8 @@ async def manual_token_input(
         print(f"[Manual] 用户 {user.username} 手动添加凭证，获得 {reward} 额度", flush=True)
     
     await db.commit()
+    token_index.upsert(new_token)
+    auth_cache.invalidate_user(user.id)
     
     return {
         "message": "Token 添加成功",
@@ -1,16 +1,30 @@
 from fastapi import APIRouter, Depends, HTTPException, Request
 from fastapi.responses import StreamingResponse, JSONResponse
-from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func
-from datetime import date
+from contextlib import aclosing
+import asyncio
 import json
 import httpx
+import math
+import time
 
-from app.database import get_db
-from app.models.user import User, UsageLog
-from app.services.auth import get_current_user
+from app.services.auth import get_api_user
+from app.services.auth_cache import UserSnapshot
 from app.services.token_pool import TokenPool
+from app.services.token_index import PooledToken
+from app.services.scheduler import token_scheduler
 from app.services.gemini_client import GeminiClient
+from app.services.http_client import (
+    get_antigravity_client, acquire_upstream_slot, release_upstream_slot, UpstreamBusyError
+)
+from app.services.retry import RetryBudget, UpstreamError, is_retryable
+from app.services.hedging import latency_tracker
+from app.services.sse import SSE_KEEPALIVE
+from app.services.cooldown import parse_retry_after
+from app.services.usage_writer import usage_writer, UsageBacklogError, HEDGE_ERROR_PREFIX
+from app.services.stats_writer import token_stats_buffer
+from app.services.quota import quota_tracker
+from app.services.rate_limit import rate_limiter
+from app.services.admission import admission_scheduler, AdmissionRejected
 from app.config import settings
 
 
@@ -18,31 +32,52 @@ def is_claude_model(model: str) -> bool:
     """判断是否是 Claude 模型"""
     return "claude" in model.lower()
 
-router = APIRouter(prefix="/v1", tags=["API代理"])
 
+class ClosingStreamingResponse(StreamingResponse):
+    """响应结束后关闭数据源
 
-async def check_quota(user: User, db: AsyncSession):
-    """检查用户配额"""
-    today = date.today()
-    result = await db.execute(
-        select(func.count(UsageLog.id)).where(
-            UsageLog.user_id == user.id,
-            func.date(UsageLog.created_at) == today
-        )
-    )
-    today_usage = result.scalar() or 0
+    客户端在响应开始迭代之前断开（或发送失败）时 body_iterator 不会被迭代，
+    数据源中持有的上游连接和并发槽位要等到 GC 才释放，这里在响应结束时统一关闭。
+    """
     
-    if today_usage >= user.daily_quota:
-        raise HTTPException(status_code=429, detail="已达到今日配额限制")
+    def __init__(self, content, source, **kwargs):
+        super().__init__(content, **kwargs)
+        self.source = source
     
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.source.aclose()
+
+
+router = APIRouter(prefix="/v1", tags=["API代理"])
+
+
+async def check_quota(user: UserSnapshot) -> int:
+    """检查并占用用户配额，返回占用后的当日用量"""
+    today_usage = await quota_tracker.consume(user.id, user.daily_quota)
+    if today_usage is None:
+        raise HTTPException(status_code=429, detail="已达到今日配额限制")
     return today_usage
 
 
+async def check_rate_limit(user: UserSnapshot, contributor: bool):
+    """按每分钟请求数限流，捐赠了公共 token 的用户使用更高的限额，管理员默认不限流"""
+    if user.is_admin and settings.rate_limit_exempt_admins:
+        return
+    rpm = settings.contributor_rpm if contributor else settings.base_rpm
+    wait = await rate_limiter.acquire(user.id, rpm)
+    if wait > 0:
+        raise HTTPException(
+            status_code=429,
+            detail=f"请求过于频繁，每分钟最多 {rpm} 次",
+            headers={"Retry-After": str(math.ceil(wait))}
+        )
+
+
 @router.get("/models")
-async def list_models(
-    user: User = Depends(get_current_user),
-    db: AsyncSession = Depends(get_db)
-):
+async def list_models(user: UserSnapshot = Depends(get_api_user)):
     """获取可用模型列表"""
     # Gemini 模型
     gemini_models = [
@@ -74,11 +109,11 @@ async def list_models(
 @router.post("/chat/completions")
 async def chat_completions(
     request: Request,
-    user: User = Depends(get_current_user),
-    db: AsyncSession = Depends(get_db)
+    user: UserSnapshot = Depends(get_api_user)
 ):
     """聊天补全 API"""
-    await check_quota(user, db)
+    contributor = user.contributor
+    await check_rate_limit(user, contributor)
     
     body = await request.json()
     model = body.get("model", "gemini-2.5-flash")
@@ -88,130 +123,364 @@ async def chat_completions(
     if not messages:
         raise HTTPException(status_code=400, detail="messages 不能为空")
     
-    # 获取 token
-    token_info = await TokenPool.get_token_for_request(db, user, model)
-    if not token_info:
-        raise HTTPException(status_code=503, detail="没有可用的 Token，请上传或等待")
+    # 排队等待上游调用名额，捐赠用户权重更高
+    try:
+        ticket = await admission_scheduler.acquire(
+            user.id, settings.admission_contributor_weight if contributor else 1.0
+        )
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=503, detail=str(e))
     
-    token_id, token_obj = token_info
+    try:
+        # 获取 token
+        tried = set()
+        token_info = TokenPool.get_token_for_request(user, model)
+        if not token_info:
+            raise HTTPException(status_code=503, detail="没有可用的 Token，请上传或等待")
+        
+        token_id, token_obj = token_info
+        tried.add(token_id)
+        
+        # 记录使用（请求结束时提交给后台批量写入）；写入积压时在占用配额之前拒绝
+        try:
+            usage = await usage_writer.begin(user.id, model, token_id)
+        except UsageBacklogError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        
+        await check_quota(user)
+    except BaseException:
+        ticket.release()
+        raise
     
-    # 记录使用
-    log = UsageLog(user_id=user.id, token_id=token_id, model=model)
-    db.add(log)
-    await db.commit()
+    claude = is_claude_model(model)
+    kwargs = {k: v for k, v in body.items() if k not in ["model", "messages", "stream"]}
+    budget = RetryBudget()
     
-    # Claude 模型 -> 转发到 Antigravity 服务
-    if is_claude_model(model):
-        return await proxy_to_antigravity(body, stream, token_id, db)
+    # Claude 请求统一使用 Antigravity 的 API Key，没有用到 token 的凭证：
+    # 失败不记到 token 上，也不换 token，重试时直接再请求同一个上游
+    async def report_failure(failed_token_id: int, error: Exception):
+        """记录失败；上游限流时让 token 进入冷却"""
+        if claude:
+            print(f"[Proxy] Claude: Antigravity 调用失败: {error}", flush=True)
+            return
+        await TokenPool.report_failure(
+            failed_token_id, str(error),
+            model=model,
+            status_code=getattr(error, "status_code", None),
+            retry_after=getattr(error, "retry_after", None)
+        )
     
-    # Gemini 模型 -> 直接调用 Google API
-    access_token = await TokenPool.get_access_token(token_obj, db)
-    if not access_token:
-        await TokenPool.report_failure(db, token_id, "Token 刷新失败")
-        raise HTTPException(status_code=503, detail="Token 已失效，无法刷新")
+    def report_success(succeeded_token_id: int):
+        if not claude:
+            TokenPool.report_success(succeeded_token_id)
     
-    project_id = token_obj.project_id or ""
-    print(f"[Proxy] Gemini: Token #{token_id}, project_id: {project_id}, model: {model}", flush=True)
+    def should_retry(error: Exception, before_first_byte: bool = False) -> bool:
+        """错误可以重试且预算未耗尽；Claude 重试同一个上游，上游要求的冷却超过剩余时间时不再重试"""
+        if not is_retryable(error, before_first_byte):
+            return False
+        if claude and (getattr(error, "retry_after", None) or 0) > budget.remaining():
+            return False
+        return budget.next_attempt()
     
-    client = GeminiClient(access_token, project_id)
+    async def next_token():
+        """换一个没有用过的 token（Claude 请求继续使用原来的）"""
+        if claude:
+            return token_id, token_obj
+        info = TokenPool.get_token_for_request(user, model, exclude=tried)
+        if info:
+            tried.add(info[0])
+        return info
     
-    try:
-        if stream:
-            async def stream_response():
+    async def open_attempt(token_obj: PooledToken):
+        """对一个 token 发起一次流式尝试，延迟按首个内容块计算"""
+        if claude:
+            async with aclosing(antigravity_stream(body)) as attempt:
+                async for chunk in attempt:
+                    yield chunk
+            return
+        started = time.monotonic()
+        latency = success = None
+        token_scheduler.acquire(token_obj.id)
+        try:
+            async with aclosing(gemini_stream(token_obj, model, messages, kwargs)) as attempt:
+                async for chunk in attempt:
+                    if latency is None and chunk is not SSE_KEEPALIVE:
+                        latency = time.monotonic() - started
+                    yield chunk
+            success = True
+        except Exception:
+            success = False
+            raise
+        finally:
+            # 被取消或客户端断开时 success 为 None，不影响 token 的健康状态
+            token_scheduler.release(token_obj.id, latency, success)
+    
+    async def call_once(token_obj: PooledToken) -> dict:
+        """对一个 token 发起一次非流式调用，成功时记录延迟"""
+        if claude:
+            return await antigravity_completion(body)
+        started = time.monotonic()
+        latency = success = None
+        cancelled = False
+        token_scheduler.acquire(token_obj.id)
+        try:
+            result = await gemini_completion(token_obj, model, messages, kwargs)
+            latency = time.monotonic() - started
+            success = True
+        except asyncio.CancelledError:
+            # 被取消（对冲落后的一方）：记一次取消，已等待的时间作为延迟下限
+            cancelled = True
+            latency = time.monotonic() - started
+            raise
+        except Exception:
+            success = False
+            raise
+        finally:
+            token_scheduler.release(token_obj.id, latency, success, cancelled)
+        latency_tracker.observe(model, latency)
+        return result
+    
+    def record_hedge_attempt(attempt_token_id: int, error: str):
+        """对冲请求中没有被采用的一次调用：写一条使用日志（不占配额）并计入 token 的失败次数"""
+        usage_writer.record_hedge_attempt(user.id, model, attempt_token_id, error)
+        token_stats_buffer.record_failure(attempt_token_id, HEDGE_ERROR_PREFIX + error)
+    
+    async def hedged_call() -> dict:
+        """对冲请求：首个尝试超过延迟阈值仍未返回时，用另一个 token 再发一次，先返回者胜出
+
+        落后的一方被取消，在调度器中记为该 token 的一次取消（见 call_once），并单独写一条使用日志；
+        先失败的一方同样单独记录。最终结果所用的 token 由外层记录。
+        """
+        nonlocal token_id, token_obj
+        attempts = {asyncio.create_task(call_once(token_obj)): (token_id, token_obj)}
+        pending = set(attempts)
+        failed = None
+        try:
+            done, pending = await asyncio.wait(pending, timeout=latency_tracker.hedge_delay(model))
+            if done or not budget.next_attempt():
+                return await next(iter(attempts))
+            
+            hedge_info = await next_token()
+            if not hedge_info:
+                return await next(iter(attempts))
+            
+            print(f"[Proxy] 对冲请求: Token #{token_id} 未响应，追加 Token #{hedge_info[0]}", flush=True)
+            attempts[asyncio.create_task(call_once(hedge_info[1]))] = hedge_info
+            pending = set(attempts)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    # 先失败的一方在这里记录，最后失败的一方交给外层重试逻辑记录
+                    if failed is not None:
+                        await report_failure(attempts[failed][0], failed.exception())
+                        usage_writer.record_hedge_attempt(
+                            user.id, model, attempts[failed][0], f"failed: {failed.exception()}"
+                        )
+                        failed = None
+                    if task.exception() is None:
+                        token_id, token_obj = attempts[task]
+                        return task.result()
+                    failed = task
+        finally:
+            # 请求本身被取消时 pending 里可能还有正在进行的调用，一并取消并等待结束
+            for task in pending:
+                task.cancel()
+                print(f"[Proxy] 对冲请求: 取消 Token #{attempts[task][0]}", flush=True)
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+            for task in pending:
+                # token_id 对应的调用由外层记录
+                if attempts[task][0] != token_id:
+                    record_hedge_attempt(attempts[task][0], "cancelled")
+        
+        token_id, token_obj = attempts[failed]
+        raise failed.exception()
+    
+    # 非流式：逐个 token 尝试，直到成功或预算耗尽
+    if not stream:
+        try:
+            while True:
                 try:
-                    async for chunk in client.chat_completions_stream(
-                        model=model,
-                        messages=messages,
-                        **{k: v for k, v in body.items() if k not in ["model", "messages", "stream"]}
-                    ):
-                        yield chunk
-                    await TokenPool.report_success(db, token_id)
+                    # Claude 请求都发往同一个上游，对冲只会加倍负载，不能换到更快的 token
+                    if settings.hedge_enabled and not claude:
+                        result = await hedged_call()
+                    else:
+                        result = await call_once(token_obj)
+                    # 使用日志记录实际完成请求的 token
+                    usage_writer.finish(usage, token_id)
+                    report_success(token_id)
+                    return JSONResponse(content=result)
                 except Exception as e:
-                    await TokenPool.report_failure(db, token_id, str(e))
-                    yield f"data: {json.dumps({'error': str(e)})}\n\n"
-            
-            return StreamingResponse(
-                stream_response(),
-                media_type="text/event-stream",
-                headers={"Cache-Control": "no-cache", "Connection": "keep-alive"}
-            )
-        else:
-            result = await client.chat_completions(
-                model=model,
-                messages=messages,
-                **{k: v for k, v in body.items() if k not in ["model", "messages", "stream"]}
-            )
-            await TokenPool.report_success(db, token_id)
-            return JSONResponse(content=result)
-    
-    except Exception as e:
-        await TokenPool.report_failure(db, token_id, str(e))
-        raise HTTPException(status_code=500, detail=str(e))
-
-
-async def proxy_to_antigravity(body: dict, stream: bool, token_id: int, db: AsyncSession):
-    """转发请求到 Antigravity 服务（用于 Claude 模型）"""
-    from app.services.crypto import decrypt_token
-    from app.models.user import Token
-    
-    # 获取原始 token
-    result = await db.execute(select(Token).where(Token.id == token_id))
-    token_obj = result.scalar_one_or_none()
-    if not token_obj:
-        raise HTTPException(status_code=503, detail="Token 不存在")
-    
-    decrypted = decrypt_token(token_obj.token)
-    # 解析 token 格式
-    token_data = TokenPool.parse_token_data(decrypted)
-    antigravity_token = token_data["access_token"]
+                    await report_failure(token_id, e)
+                    error = e
+                
+                if not should_retry(error):
+                    raise upstream_http_exception(error, passthrough_status=claude)
+                await budget.backoff(getattr(error, "retry_after", None) if claude else None)
+                token_info = await next_token()
+                if not token_info:
+                    raise upstream_http_exception(error, passthrough_status=claude)
+                token_id, token_obj = token_info
+                print(f"[Proxy] 重试第 {budget.attempts} 次: Token #{token_id}", flush=True)
+        except BaseException as e:
+            usage_writer.finish(usage, token_id, success=False, error=str(e) or type(e).__name__)
+            raise
+        finally:
+            ticket.release()
+    
+    # 流式：在向客户端输出实际内容之前的失败都可以换 token 重试
+    async def stream_with_failover():
+        nonlocal token_id, token_obj
+        started = False
+        try:
+            while True:
+                committed = False
+                try:
+                    async with aclosing(open_attempt(token_obj)) as attempt:
+                        async for chunk in attempt:
+                            if chunk is not SSE_KEEPALIVE:
+                                committed = True
+                            started = True
+                            yield chunk
+                    usage_writer.finish(usage, token_id)
+                    report_success(token_id)
+                    return
+                except Exception as e:
+                    await report_failure(token_id, e)
+                    error = e
+                
+                retry = not committed and should_retry(error, before_first_byte=True)
+                if retry:
+                    await budget.backoff(getattr(error, "retry_after", None) if claude else None)
+                    token_info = await next_token()
+                    retry = token_info is not None
+                if not retry:
+                    usage_writer.finish(usage, token_id, success=False, error=str(error))
+                    if not started:
+                        raise error
+                    yield f"data: {json.dumps({'error': str(error)})}\n\n"
+                    return
+                token_id, token_obj = token_info
+                print(f"[Proxy] 重试第 {budget.attempts} 次: Token #{token_id}", flush=True)
+        finally:
+            # 客户端断开或被取消时也要提交使用记录
+            usage_writer.finish(usage, token_id, success=False, error="客户端断开连接")
+            ticket.release()
     
+    # 预取第一个块：所有尝试在输出前都失败时返回真实的 HTTP 错误
+    # 交给响应之前的任何退出路径都要关闭 chunks，否则上游连接和槽位要等到 GC 才释放
+    chunks = stream_with_failover()
+    try:
+        try:
+            first = await chunks.__anext__()
+        except StopAsyncIteration:
+            first = b""
+        
+        async def stream_response():
+            yield first
+            async for chunk in chunks:
+                yield chunk
+        
+        return ClosingStreamingResponse(
+            stream_response(),
+            chunks,
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "Connection": "keep-alive"}
+        )
+    except BaseException as e:
+        await chunks.aclose()
+        if isinstance(e, Exception):
+            raise upstream_http_exception(e, passthrough_status=claude)
+        raise
+
+
+def upstream_http_exception(error: Exception, passthrough_status: bool = False) -> HTTPException:
+    """将上游错误转换为返回给客户端的 HTTPException"""
+    if isinstance(error, HTTPException):
+        return error
+    if isinstance(error, UpstreamBusyError):
+        return HTTPException(status_code=503, detail=str(error))
+    if isinstance(error, httpx.TimeoutException):
+        return HTTPException(status_code=504, detail="请求超时")
+    if isinstance(error, UpstreamError) and error.status_code and (passthrough_status or error.status_code == 429):
+        return HTTPException(status_code=error.status_code, detail=str(error))
+    return HTTPException(status_code=500, detail=str(error))
+
+
+async def gemini_client_for(token_obj: PooledToken, model: str) -> GeminiClient:
+    """为 token 创建 Gemini 客户端（必要时刷新 access_token）"""
+    access_token = await TokenPool.get_access_token(token_obj)
+    if not access_token:
+        raise UpstreamError("Token 刷新失败", retryable=True)
+    
+    project_id = token_obj.project_id or ""
+    print(f"[Proxy] Gemini: Token #{token_obj.id}, project_id: {project_id}, model: {model}", flush=True)
+    return GeminiClient(access_token, project_id)
+
+
+async def gemini_completion(token_obj: PooledToken, model: str, messages: list, kwargs: dict) -> dict:
+    """Gemini 非流式调用"""
+    client = await gemini_client_for(token_obj, model)
+    return await client.chat_completions(model=model, messages=messages, **kwargs)
+
+
+async def gemini_stream(token_obj: PooledToken, model: str, messages: list, kwargs: dict):
+    """Gemini 流式调用"""
+    client = await gemini_client_for(token_obj, model)
+    async with aclosing(client.chat_completions_stream(model=model, messages=messages, **kwargs)) as chunks:
+        async for chunk in chunks:
+            yield chunk
+
+
+def antigravity_request(body: dict) -> httpx.Request:
+    """构建转发到 Antigravity 服务的请求（用于 Claude 模型）"""
     print(f"[Proxy] Claude: 转发到 Antigravity 服务, model: {body.get('model')}", flush=True)
     
     # 使用配置的 Antigravity API Key
     api_key = settings.antigravity_api_key
+    return get_antigravity_client().build_request(
+        "POST",
+        f"{settings.antigravity_api_base}/chat/completions",
+        headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
+        json=body
+    )
+
+
+async def antigravity_completion(body: dict) -> dict:
+    """Antigravity 非流式调用"""
+    base = settings.antigravity_api_base
+    await acquire_upstream_slot(base)
+    try:
+        response = await get_antigravity_client().send(antigravity_request(body))
+    finally:
+        release_upstream_slot(base)
     
+    if response.status_code != 200:
+        raise UpstreamError(
+            response.text,
+            status_code=response.status_code,
+            retry_after=parse_retry_after(response.headers, response.text)
+        )
+    return response.json()
+
+
+async def antigravity_stream(body: dict):
+    """Antigravity 流式调用，响应和并发槽位在整个流的生命周期内保持"""
+    base = settings.antigravity_api_base
+    await acquire_upstream_slot(base)
     try:
-        async with httpx.AsyncClient(timeout=300) as client:
-            if stream:
-                async def stream_response():
-                    try:
-                        async with client.stream(
-                            "POST",
-                            f"{settings.antigravity_api_base}/chat/completions",
-                            headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
-                            json=body
-                        ) as response:
-                            if response.status_code != 200:
-                                error_text = await response.aread()
-                                await TokenPool.report_failure(db, token_id, error_text.decode())
-                                yield f"data: {json.dumps({'error': error_text.decode()})}\n\n"
-                                return
-                            async for chunk in response.aiter_bytes():
-                                yield chunk
-                            await TokenPool.report_success(db, token_id)
-                    except Exception as e:
-                        await TokenPool.report_failure(db, token_id, str(e))
-                        yield f"data: {json.dumps({'error': str(e)})}\n\n"
-                
-                return StreamingResponse(
-                    stream_response(),
-                    media_type="text/event-stream",
-                    headers={"Cache-Control": "no-cache", "Connection": "keep-alive"}
-                )
-            else:
-                response = await client.post(
-                    f"{settings.antigravity_api_base}/chat/completions",
-                    headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
-                    json=body
+        response = await get_antigravity_client().send(antigravity_request(body), stream=True)
+        try:
+            if response.status_code != 200:
+                error_text = (await response.aread()).decode(errors="replace")
+                raise UpstreamError(
+                    error_text,
+                    status_code=response.status_code,
+                    retry_after=parse_retry_after(response.headers, error_text)
                 )
-                if response.status_code != 200:
-                    await TokenPool.report_failure(db, token_id, response.text)
-                    raise HTTPException(status_code=response.status_code, detail=response.text)
-                await TokenPool.report_success(db, token_id)
-                return JSONResponse(content=response.json())
-    except httpx.TimeoutException:
-        await TokenPool.report_failure(db, token_id, "请求超时")
-        raise HTTPException(status_code=504, detail="请求超时")
-    except Exception as e:
-        await TokenPool.report_failure(db, token_id, str(e))
-        raise HTTPException(status_code=500, detail=str(e))
+            async for chunk in response.aiter_bytes():
+                yield chunk
+        finally:
+            await response.aclose()
+    finally:
+        release_upstream_slot(base)
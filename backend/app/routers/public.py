@@ -1,43 +1,30 @@
-from fastapi import APIRouter, Depends
-from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func
-from datetime import date
-
-from app.database import get_db
-from app.models.user import User, Token, UsageLog
-from app.services.token_pool import TokenPool
+from fastapi import APIRouter, Request, Response
+
+from app.services.public_stats import public_stats
 from app.config import settings
 
 router = APIRouter(prefix="/api/public", tags=["公开接口"])
 
 
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match 是否匹配 etag：支持 *、逗号分隔的多个值，按弱比较忽略 W/ 前缀"""
+    if if_none_match.strip() == "*":
+        return True
+    etag = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
 @router.get("/stats")
-async def get_public_stats(db: AsyncSession = Depends(get_db)):
-    """获取公开统计信息"""
-    # 用户数
-    user_result = await db.execute(select(func.count(User.id)))
-    user_count = user_result.scalar() or 0
-    
-    # Token 池统计
-    pool_stats = await TokenPool.get_pool_stats(db)
-    
-    # 今日请求数
-    today = date.today()
-    today_result = await db.execute(
-        select(func.count(UsageLog.id)).where(func.date(UsageLog.created_at) == today)
-    )
-    today_requests = today_result.scalar() or 0
-    
-    # 总请求数
-    total_result = await db.execute(select(func.count(UsageLog.id)))
-    total_requests = total_result.scalar() or 0
-    
-    return {
-        "users": user_count,
-        "tokens": pool_stats,
-        "today_requests": today_requests,
-        "total_requests": total_requests
+async def get_public_stats(request: Request):
+    """获取公开统计信息（后台定期计算的快照）"""
+    body, etag = public_stats.get()
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={int(settings.public_stats_interval)}"
     }
+    if etag_matches(request.headers.get("if-none-match", ""), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 
 @router.get("/announcement")
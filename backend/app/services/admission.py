@@ -0,0 +1,148 @@
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Dict, List, Tuple
+
+from app.config import settings
+
+
+class AdmissionRejected(Exception):
+    """排队超时或队列已满"""
+    pass
+
+
+class AdmissionTicket:
+    """一个上游调用名额，请求结束时 release()（重复调用只生效一次）"""
+    __slots__ = ("_scheduler", "user_id", "started", "released")
+
+    def __init__(self, scheduler: "AdmissionScheduler", user_id: int):
+        self._scheduler = scheduler
+        self.user_id = user_id
+        self.started = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self._scheduler._release(self)
+
+
+class _NoopTicket:
+    released = True
+
+    def release(self):
+        pass
+
+
+class AdmissionScheduler:
+    """上游调用的准入控制
+
+    同时进行的上游调用总数不超过 admission_max_inflight，每个用户不超过
+    admission_user_max_inflight（0 表示不限制）。超出的请求按加权公平队列（WFQ）排队：
+    每个请求的虚拟完成时间为 max(虚拟时间, 该用户上一个请求的完成时间) + 1/权重，
+    名额空出时放行完成时间最小、且用户未达上限的请求。捐赠了公共 token 的用户
+    权重更高。预计排队时间超过 admission_queue_timeout 时直接拒绝。
+    """
+
+    def __init__(self):
+        self._inflight = 0
+        self._user_inflight: Dict[int, int] = {}
+        self._queue: List[Tuple[float, int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._virtual_time = 0.0
+        self._user_finish: Dict[int, float] = {}
+        self._hold_time = 1.0  # 名额平均占用时间（秒，EWMA）
+
+    def _can_run(self, user_id: int) -> bool:
+        user_cap = settings.admission_user_max_inflight
+        return (
+            self._inflight < settings.admission_max_inflight
+            and (user_cap <= 0 or self._user_inflight.get(user_id, 0) < user_cap)
+        )
+
+    def _grant(self, user_id: int) -> AdmissionTicket:
+        self._inflight += 1
+        self._user_inflight[user_id] = self._user_inflight.get(user_id, 0) + 1
+        return AdmissionTicket(self, user_id)
+
+    async def acquire(self, user_id: int, weight: float = 1.0):
+        """获取一个名额，排队超时或队列已满时抛出 AdmissionRejected"""
+        if settings.admission_max_inflight <= 0:
+            return _NoopTicket()
+        # 队列中的请求都在等待名额或受用户并发上限限制，可以直接放行
+        if self._can_run(user_id):
+            return self._grant(user_id)
+
+        if len(self._queue) >= settings.admission_max_queue:
+            # 清掉已经超时离开的条目
+            self._queue = [item for item in self._queue if not item[3].done()]
+            heapq.heapify(self._queue)
+        if len(self._queue) >= settings.admission_max_queue:
+            raise AdmissionRejected("服务繁忙，排队请求过多")
+
+        timeout = settings.admission_queue_timeout
+        tag = max(self._virtual_time, self._user_finish.get(user_id, 0.0)) + 1.0 / max(weight, 0.01)
+        ahead = own = 0
+        for item in self._queue:
+            if not item[3].done():
+                ahead += item[0] <= tag
+                own += item[2] == user_id
+        estimated = (ahead + 1) * self._hold_time / settings.admission_max_inflight
+        if settings.admission_user_max_inflight > 0:
+            estimated = max(estimated, (own + 1) * self._hold_time / settings.admission_user_max_inflight)
+        if estimated > timeout:
+            raise AdmissionRejected("服务繁忙，预计排队时间过长")
+
+        self._user_finish[user_id] = tag
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (tag, next(self._seq), user_id, future))
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # 放行和超时同时发生
+                future.result().release()
+            else:
+                future.cancel()
+            if isinstance(e, asyncio.TimeoutError):
+                raise AdmissionRejected("服务繁忙，排队超时") from None
+            raise
+
+    def _release(self, ticket: AdmissionTicket):
+        user_id = ticket.user_id
+        self._inflight -= 1
+        count = self._user_inflight.get(user_id, 0) - 1
+        if count > 0:
+            self._user_inflight[user_id] = count
+        else:
+            self._user_inflight.pop(user_id, None)
+            if self._user_finish.get(user_id, 0.0) <= self._virtual_time:
+                self._user_finish.pop(user_id, None)
+        self._hold_time += 0.2 * (time.monotonic() - ticket.started - self._hold_time)
+        self._dispatch()
+
+    def _dispatch(self):
+        skipped = []
+        while self._queue and self._inflight < settings.admission_max_inflight:
+            item = heapq.heappop(self._queue)
+            tag, _, user_id, future = item
+            if future.done():
+                continue
+            if not self._can_run(user_id):
+                skipped.append(item)
+                continue
+            self._virtual_time = tag
+            future.set_result(self._grant(user_id))
+        for item in skipped:
+            heapq.heappush(self._queue, item)
+
+    def snapshot(self) -> dict:
+        return {
+            "inflight": self._inflight,
+            "queued": sum(1 for item in self._queue if not item[3].done()),
+            "avg_hold_time": round(self._hold_time, 2),
+        }
+
+
+admission_scheduler = AdmissionScheduler()
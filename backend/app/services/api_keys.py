@@ -0,0 +1,80 @@
+import asyncio
+import hashlib
+import secrets
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+
+from sqlalchemy import select
+
+from app.config import settings
+from app.services.auth_cache import auth_cache
+
+API_KEY_PREFIX = "sk-ag-"
+
+
+def generate_api_key() -> Tuple[str, str]:
+    """生成新的 API Key，返回 (明文, 摘要)；明文只在创建时返回给用户一次"""
+    key = API_KEY_PREFIX + secrets.token_urlsafe(32)
+    return key, hash_api_key(key)
+
+
+def hash_api_key(key: str) -> str:
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def api_key_cache_key(key_hash: str) -> str:
+    """API Key 在认证缓存中的键（缓存里不保存明文）"""
+    return f"apikey:{key_hash}"
+
+
+class RevocationWatcher:
+    """把其他进程吊销的 API Key 从本进程的认证缓存中移除
+
+    本进程吊销时直接清缓存；其他进程的吊销每 api_key_revocation_poll_interval
+    秒通过 revoked_at 索引查询一次。
+    """
+
+    def __init__(self):
+        self._since: Optional[datetime] = None
+        self._runner: Optional[asyncio.Task] = None
+
+    async def poll(self):
+        from app.database import async_session
+        from app.models.user import ApiKey
+
+        since = self._since or datetime.utcnow()
+        # 多查一小段时间，容忍各进程之间的时钟误差
+        async with async_session() as db:
+            result = await db.execute(
+                select(ApiKey.key_hash, ApiKey.revoked_at).where(ApiKey.revoked_at >= since - timedelta(seconds=5))
+            )
+            rows = result.all()
+        for key_hash, revoked_at in rows:
+            auth_cache.invalidate(api_key_cache_key(key_hash))
+            since = max(since, revoked_at)
+        self._since = since
+
+    async def _run(self):
+        while settings.api_key_revocation_poll_interval > 0:
+            await asyncio.sleep(settings.api_key_revocation_poll_interval)
+            try:
+                await self.poll()
+            except Exception as e:
+                print(f"[ApiKey] 查询已吊销的 Key 失败: {e}", flush=True)
+
+    async def start(self):
+        if self._runner is None:
+            self._since = datetime.utcnow()
+            self._runner = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._runner is not None:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
+
+
+revocation_watcher = RevocationWatcher()
@@ -1,5 +1,7 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Tuple
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
@@ -8,11 +10,25 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 
 from app.config import settings
-from app.database import get_db
-from app.models.user import User
+from app.database import get_db, async_session
+from app.models.user import User, ApiKey
+from app.services.auth_cache import auth_cache, UserSnapshot
+from app.services.api_keys import API_KEY_PREFIX, hash_api_key, api_key_cache_key
 
 # 密码加密 - 使用 argon2 避免 bcrypt 兼容性问题
-pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
+pwd_context = CryptContext(
+    schemes=["argon2"],
+    deprecated="auto",
+    argon2__time_cost=settings.argon2_time_cost,
+    argon2__memory_cost=settings.argon2_memory_cost,
+    argon2__parallelism=settings.argon2_parallelism
+)
+
+# argon2 在独立的线程池中计算，不阻塞事件循环
+_password_executor = ThreadPoolExecutor(
+    max_workers=settings.password_hash_workers, thread_name_prefix="argon2"
+)
+_password_jobs = 0
 
 # JWT 配置
 ALGORITHM = "HS256"
@@ -29,6 +45,31 @@ def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
 
+async def _run_password_job(func, *args):
+    """在密码线程池中执行，排队的任务过多时直接返回 503"""
+    global _password_jobs
+    if _password_jobs >= settings.password_hash_max_pending:
+        raise HTTPException(
+            status_code=503,
+            detail="登录请求过多，请稍后重试",
+            headers={"Retry-After": "1"}
+        )
+    _password_jobs += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_password_executor, func, *args)
+    finally:
+        _password_jobs -= 1
+
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """校验密码，返回 (是否正确, 新哈希)；成本参数调整后会返回按新参数计算的哈希"""
+    return await _run_password_job(pwd_context.verify_and_update, plain_password, hashed_password)
+
+
+async def get_password_hash_async(password: str) -> str:
+    return await _run_password_job(pwd_context.hash, password)
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     to_encode = data.copy()
     expire = datetime.utcnow() + (expires_delta or timedelta(days=ACCESS_TOKEN_EXPIRE_DAYS))
@@ -36,56 +77,121 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     return jwt.encode(to_encode, settings.secret_key, algorithm=ALGORITHM)
 
 
-async def get_user_by_api_key(db: AsyncSession, api_key: str) -> Optional[User]:
-    """通过 API Key 获取用户（API Key = JWT token 或 sk-前缀格式）"""
-    # 移除 sk- 前缀
-    if api_key.startswith("sk-"):
-        api_key = api_key[3:]
-    
+def _decode_token(token: str) -> Tuple[Optional[str], Optional[float]]:
+    """解码 JWT，返回 (用户名, 过期时间)；无效时用户名为 None"""
     try:
-        payload = jwt.decode(api_key, settings.secret_key, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            return None
+        payload = jwt.decode(token, settings.secret_key, algorithms=[ALGORITHM])
     except JWTError:
-        return None
+        return None, None
+    return payload.get("sub"), payload.get("exp")
+
+
+async def _authenticate(credentials: Optional[HTTPAuthorizationCredentials], db: AsyncSession) -> User:
+    """控制台接口的认证：凭证经 resolve_user 校验（走认证缓存），再按主键取出会话中的用户行
+
+    这些接口会修改用户行（额度、密码、登录时间），所以返回绑定到 db 的 User 对象。
+    API Key 只能调用 /v1 接口。
+    """
+    if not credentials:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="未登录"
+        )
+    if credentials.credentials.startswith(API_KEY_PREFIX):
+        raise HTTPException(status_code=401, detail="无效的token")
     
-    result = await db.execute(select(User).where(User.username == username))
-    return result.scalar_one_or_none()
+    snapshot = await resolve_user(credentials.credentials)
+    user = await db.get(User, snapshot.id)
+    if user is None:
+        auth_cache.invalidate_user(snapshot.id)
+        raise HTTPException(status_code=401, detail="用户不存在")
+    return user
 
 
 async def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
     db: AsyncSession = Depends(get_db)
 ) -> User:
-    if not credentials:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="未登录"
+    return await _authenticate(credentials, db)
+
+
+async def _resolve_api_key(key: str) -> UserSnapshot:
+    """API Key → 用户快照：摘要只计算一次，按唯一索引查询"""
+    key_hash = hash_api_key(key)
+    cache_key = api_key_cache_key(key_hash)
+    
+    cached = auth_cache.get(cache_key)
+    if cached is not None:
+        snapshot, error = cached
+        if snapshot is None:
+            raise HTTPException(status_code=401, detail=error)
+        return snapshot
+    
+    async with async_session() as db:
+        result = await db.execute(
+            select(User).join(ApiKey, ApiKey.user_id == User.id).where(
+                ApiKey.key_hash == key_hash, ApiKey.revoked_at.is_(None)
+            )
         )
+        user = result.scalar_one_or_none()
+    if user is None:
+        auth_cache.put_invalid(cache_key, "无效的 API Key")
+        raise HTTPException(status_code=401, detail="无效的 API Key")
+    
+    snapshot = UserSnapshot.from_user(user)
+    auth_cache.put(cache_key, snapshot)
+    return snapshot
+
+
+async def resolve_user(token: str) -> UserSnapshot:
+    """凭证 → 用户快照，优先使用认证缓存，无效时抛出 401"""
+    if token.startswith(API_KEY_PREFIX):
+        snapshot = await _resolve_api_key(token)
+        if not snapshot.is_active:
+            raise HTTPException(status_code=401, detail="用户已被禁用")
+        return snapshot
     
-    token = credentials.credentials
-    # 支持 sk- 前缀
     if token.startswith("sk-"):
         token = token[3:]
     
-    try:
-        payload = jwt.decode(token, settings.secret_key, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
+    cached = auth_cache.get(token)
+    if cached is not None:
+        snapshot, error = cached
+        if snapshot is None:
+            raise HTTPException(status_code=401, detail=error)
+    else:
+        username, expires_at = _decode_token(token)
         if username is None:
+            auth_cache.put_invalid(token, "无效的token")
             raise HTTPException(status_code=401, detail="无效的token")
-    except JWTError:
-        raise HTTPException(status_code=401, detail="无效的token")
+        
+        async with async_session() as db:
+            result = await db.execute(select(User).where(User.username == username))
+            user = result.scalar_one_or_none()
+        if user is None:
+            auth_cache.put_invalid(token, "用户不存在")
+            raise HTTPException(status_code=401, detail="用户不存在")
+        
+        snapshot = UserSnapshot.from_user(user)
+        auth_cache.put(token, snapshot, expires_at)
     
-    result = await db.execute(select(User).where(User.username == username))
-    user = result.scalar_one_or_none()
-    
-    if user is None:
-        raise HTTPException(status_code=401, detail="用户不存在")
-    if not user.is_active:
+    if not snapshot.is_active:
         raise HTTPException(status_code=401, detail="用户已被禁用")
-    
-    return user
+    return snapshot
+
+
+async def get_api_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> UserSnapshot:
+    """API 代理用的认证：返回缓存的用户快照，命中时不访问数据库
+
+    未命中时在独立的短会话中查询，不占用 get_db 的会话（它要到响应结束才释放，
+    长时间的流式响应会一直占用它）。
+    """
+    if not credentials:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="未登录"
+        )
+    return await resolve_user(credentials.credentials)
 
 
 async def get_current_admin(user: User = Depends(get_current_user)) -> User:
@@ -100,14 +206,7 @@ async def get_optional_user(
 ) -> Optional[User]:
     if not credentials:
         return None
-    
     try:
-        payload = jwt.decode(credentials.credentials, settings.secret_key, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            return None
-    except JWTError:
+        return await _authenticate(credentials, db)
+    except HTTPException:
         return None
-    
-    result = await db.execute(select(User).where(User.username == username))
-    return result.scalar_one_or_none()
@@ -0,0 +1,106 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional, Set, Tuple
+
+from app.config import settings
+from app.services.token_index import token_index
+
+
+@dataclass(frozen=True)
+class UserSnapshot:
+    """认证缓存中的用户快照（只读，不关联数据库会话）"""
+    id: int
+    username: str
+    is_active: bool
+    is_admin: bool
+    daily_quota: int
+
+    @classmethod
+    def from_user(cls, user) -> "UserSnapshot":
+        return cls(
+            id=user.id,
+            username=user.username,
+            is_active=bool(user.is_active),
+            is_admin=bool(user.is_admin),
+            daily_quota=user.daily_quota,
+        )
+
+    @property
+    def contributor(self) -> bool:
+        """是否有捐赠到公共池的可用 token（从 token 索引实时读取）"""
+        return token_index.has_public_tokens(self.id)
+
+
+class AuthCache:
+    """凭证 → 用户快照 的 LRU/TTL 缓存
+
+    验证通过的凭证缓存 auth_cache_ttl 秒（不超过 JWT 本身的过期时间），
+    无效的凭证缓存 auth_negative_ttl 秒，重复的无效请求不再解码和查库。
+    用户行被修改（额度变化、禁用、删除）后调用 invalidate_user()；
+    其他进程中的缓存最迟在 TTL 到期后失效。
+    """
+
+    def __init__(self):
+        # 凭证 -> (过期时间, 快照, 错误信息)；快照为 None 时表示无效凭证
+        self._entries: "OrderedDict[str, Tuple[float, Optional[UserSnapshot], Optional[str]]]" = OrderedDict()
+        self._by_user: Dict[int, Set[str]] = {}
+
+    def get(self, credential: str) -> Optional[Tuple[Optional[UserSnapshot], Optional[str]]]:
+        """命中时返回 (快照, 错误信息)，未命中返回 None"""
+        entry = self._entries.get(credential)
+        if entry is None:
+            return None
+        expires_at, snapshot, error = entry
+        if expires_at <= time.monotonic():
+            self._pop(credential)
+            return None
+        self._entries.move_to_end(credential)
+        return snapshot, error
+
+    def _put(self, credential: str, ttl: float, snapshot: Optional[UserSnapshot], error: Optional[str]):
+        if ttl <= 0 or settings.auth_cache_size <= 0:
+            return
+        self._pop(credential)
+        self._entries[credential] = (time.monotonic() + ttl, snapshot, error)
+        if snapshot is not None:
+            self._by_user.setdefault(snapshot.id, set()).add(credential)
+        while len(self._entries) > settings.auth_cache_size:
+            self._pop(next(iter(self._entries)))
+
+    def put(self, credential: str, snapshot: UserSnapshot, expires_at: Optional[float] = None):
+        """缓存验证通过的凭证，expires_at 为凭证本身的过期时间（Unix 时间戳）"""
+        ttl = settings.auth_cache_ttl
+        if expires_at is not None:
+            ttl = min(ttl, expires_at - time.time())
+        self._put(credential, ttl, snapshot, None)
+
+    def put_invalid(self, credential: str, error: str):
+        self._put(credential, settings.auth_negative_ttl, None, error)
+
+    def _pop(self, credential: str):
+        entry = self._entries.pop(credential, None)
+        if entry is not None and entry[1] is not None:
+            credentials = self._by_user.get(entry[1].id)
+            if credentials is not None:
+                credentials.discard(credential)
+                if not credentials:
+                    del self._by_user[entry[1].id]
+
+    def invalidate(self, credential: str):
+        self._pop(credential)
+
+    def invalidate_user(self, user_id: int):
+        """用户信息变化后丢弃该用户的所有缓存"""
+        for credential in list(self._by_user.get(user_id, ())):
+            self._pop(credential)
+
+    def clear(self):
+        self._entries.clear()
+        self._by_user.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+auth_cache = AuthCache()
@@ -0,0 +1,147 @@
+import heapq
+import re
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+from app.config import settings
+from app.services.token_index import model_family
+
+
+_DURATION_PART = re.compile(r"([\d.]+)(ms|h|m|s)")
+_RETRY_DELAY = re.compile(r'"(?:retryDelay|quotaResetDelay)"\s*:\s*"([^"]+)"')
+_RESET_TIMESTAMP = re.compile(r'"quotaResetTimeStamp"\s*:\s*"([^"]+)"')
+
+
+def _parse_duration(value: str) -> Optional[float]:
+    """解析 Google 风格的时长，例如 "12s"、"1h2m3.5s"、"300ms" """
+    total = 0.0
+    matched = False
+    for number, unit in _DURATION_PART.findall(value):
+        matched = True
+        total += float(number) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return total if matched else None
+
+
+def parse_retry_after(headers, body: str = "") -> Optional[float]:
+    """从 Retry-After 头或 Google 错误体中的配额重置提示解析冷却时间（秒）"""
+    value = headers.get("retry-after") if headers is not None else None
+    if value:
+        value = value.strip()
+        if value.isdigit():
+            return float(value)
+        try:
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            pass
+
+    if body:
+        match = _RETRY_DELAY.search(body)
+        if match:
+            seconds = _parse_duration(match.group(1))
+            if seconds is not None:
+                return seconds
+        match = _RESET_TIMESTAMP.search(body)
+        if match:
+            try:
+                reset = datetime.fromisoformat(match.group(1).replace("Z", "+00:00"))
+                return max(0.0, (reset - datetime.now(timezone.utc)).total_seconds())
+            except ValueError:
+                pass
+    return None
+
+
+class _Unavailable:
+    """选择 token 时需要跳过的集合：本次请求已尝试过的 + 正在冷却的"""
+
+    def __init__(self, queue: "CooldownQueue", family: str, exclude: Optional[Set[int]]):
+        self.queue = queue
+        self.family = family
+        self.exclude = exclude or set()
+
+    def __contains__(self, token_id: int) -> bool:
+        return token_id in self.exclude or self.queue._is_parked(token_id, self.family)
+
+    def __bool__(self) -> bool:
+        return bool(self.exclude) or bool(self.queue)
+
+
+class CooldownQueue:
+    """被限流 token 的冷却队列
+
+    按 token × 模型类型（model_family：claude / gemini）记录重新可用的时间，
+    同一类型的不同模型和 假流式/、流式抗截断/ 等变体共享冷却；
+    用最小堆按时间排序，到期的条目在访问时惰性移除。
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[float, int, str]] = []
+        self._until: Dict[Tuple[int, str], float] = {}
+        self._reasons: Dict[Tuple[int, str], str] = {}
+
+    def _expire(self):
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now:
+            until, token_id, model = heapq.heappop(self._heap)
+            key = (token_id, model)
+            # 同一个 key 被重新冷却时堆里会留下旧条目，只有时间匹配时才移除
+            if self._until.get(key) == until:
+                del self._until[key]
+                self._reasons.pop(key, None)
+
+    def park(self, token_id: int, model: str, seconds: Optional[float], reason: str = ""):
+        """让 token 在指定模型所属的类型上冷却 seconds 秒（None 时使用默认冷却时间）"""
+        if seconds is None:
+            seconds = settings.cooldown_default_seconds
+        seconds = min(max(seconds, 1.0), settings.cooldown_max_seconds)
+        model = model_family(model)
+        key = (token_id, model)
+        until = time.time() + seconds
+        if self._until.get(key, 0) >= until:
+            return
+        self._until[key] = until
+        self._reasons[key] = reason[:200]
+        heapq.heappush(self._heap, (until, token_id, model))
+        print(f"[Cooldown] Token #{token_id} ({model}) 冷却 {seconds:.0f} 秒", flush=True)
+
+    def release(self, token_id: int, model: Optional[str] = None):
+        """提前解除冷却（model 为 None 时解除该 token 的所有冷却）"""
+        if model is not None:
+            model = model_family(model)
+        for key in [k for k in self._until if k[0] == token_id and (model is None or k[1] == model)]:
+            del self._until[key]
+            self._reasons.pop(key, None)
+
+    def _is_parked(self, token_id: int, family: str) -> bool:
+        if not self._until:
+            return False
+        self._expire()
+        return (token_id, family) in self._until
+
+    def is_parked(self, token_id: int, model: str) -> bool:
+        return self._is_parked(token_id, model_family(model))
+
+    def unavailable(self, model: str, exclude: Optional[Set[int]] = None) -> _Unavailable:
+        return _Unavailable(self, model_family(model), exclude)
+
+    def snapshot(self) -> List[dict]:
+        """当前冷却状态（管理员查看）"""
+        self._expire()
+        now = time.time()
+        return sorted((
+            {
+                "token_id": token_id,
+                "model": model,
+                "until": datetime.fromtimestamp(until, timezone.utc).isoformat(),
+                "remaining": round(until - now, 1),
+                "reason": self._reasons.get((token_id, model), ""),
+            }
+            for (token_id, model), until in self._until.items()
+        ), key=lambda item: item["remaining"])
+
+    def __len__(self):
+        return len(self._until)
+
+
+cooldown_queue = CooldownQueue()
@@ -1,23 +1,58 @@
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from functools import lru_cache
+from typing import Tuple
 import base64
 import hashlib
 
 from app.config import settings
 
 
-def get_fernet_key():
+def get_fernet_key(secret_key: str = None):
     """从 secret_key 生成 Fernet 密钥"""
-    key = hashlib.sha256(settings.secret_key.encode()).digest()
+    key = hashlib.sha256((secret_key or settings.secret_key).encode()).digest()
     return base64.urlsafe_b64encode(key)
 
 
+def get_encryption_secrets() -> Tuple[str, ...]:
+    """token 加密用的密钥列表：第一个用于加密，其余只用于解密旧数据"""
+    keys = tuple(s.strip() for s in settings.encryption_keys.split(",") if s.strip())
+    return keys or (settings.secret_key,)
+
+
+@lru_cache(maxsize=4)
+def _build_fernet(keys: Tuple[str, ...]) -> MultiFernet:
+    return MultiFernet([Fernet(get_fernet_key(secret)) for secret in keys])
+
+
+@lru_cache(maxsize=4)
+def _build_primary(secret: str) -> Fernet:
+    return Fernet(get_fernet_key(secret))
+
+
+def get_fernet() -> MultiFernet:
+    """获取 Fernet 实例（按密钥列表缓存，不再每次重新派生密钥）"""
+    return _build_fernet(get_encryption_secrets())
+
+
 def encrypt_token(token: str) -> str:
     """加密 token"""
-    f = Fernet(get_fernet_key())
-    return f.encrypt(token.encode()).decode()
+    return get_fernet().encrypt(token.encode()).decode()
 
 
 def decrypt_token(encrypted_token: str) -> str:
     """解密 token"""
-    f = Fernet(get_fernet_key())
-    return f.decrypt(encrypted_token.encode()).decode()
+    return get_fernet().decrypt(encrypted_token.encode()).decode()
+
+
+def is_primary_encrypted(encrypted_token: str) -> bool:
+    """是否已经用当前的主密钥加密"""
+    try:
+        _build_primary(get_encryption_secrets()[0]).decrypt(encrypted_token.encode())
+        return True
+    except InvalidToken:
+        return False
+
+
+def rotate_token(encrypted_token: str) -> str:
+    """用主密钥重新加密（可以用任一密钥解密的密文）"""
+    return get_fernet().rotate(encrypted_token.encode()).decode()
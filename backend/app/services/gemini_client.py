@@ -1,9 +1,84 @@
+import asyncio
+import contextlib
 import httpx
-import json
-from typing import AsyncGenerator, Optional
+import time
+from typing import AsyncGenerator
+
+from app.config import settings
+from app.services.http_client import get_google_client
+from app.services.retry import UpstreamError
+from app.services.cooldown import parse_retry_after
+from app.services.sse import (
+    ChatChunkEncoder, SSE_DONE, SSE_KEEPALIVE, FINISH_REASON_MAP,
+    iter_sse_data, extract_gemini_delta, json_loads, new_completion_id
+)
 
 GOOGLE_API_URL = "https://cloudcode-pa.googleapis.com/v1internal"
 
+# 模型名前缀
+FAKE_STREAM_PREFIX = "假流式/"
+ANTI_TRUNCATION_PREFIX = "流式抗截断/"
+
+# 流式抗截断
+ANTI_TRUNCATION_MARKER = "[done]"
+ANTI_TRUNCATION_INSTRUCTION = (
+    f"当你完整地结束回答后，必须在回答的最后单独输出 {ANTI_TRUNCATION_MARKER} 作为完成标记。"
+)
+ANTI_TRUNCATION_CONTINUE_PROMPT = (
+    "你的上一条回答被截断了。请从中断的地方直接继续输出，不要重复已输出的内容，"
+    f"完成后输出 {ANTI_TRUNCATION_MARKER}。"
+)
+
+
+class CompletionMarkerFilter:
+    """从流式文本中去掉末尾的完成标记
+
+    标记只有出现在一轮回答的末尾（之后只剩空白）时才表示完成；出现在中间时
+    当作普通文本输出。末尾可能属于标记的部分（标记的前缀、完整的标记以及前后的空白）
+    先保留，收到后续文本后再决定是否输出，因此标记被拆在多个块之间也能识别。
+    """
+    
+    def __init__(self, marker: str = ANTI_TRUNCATION_MARKER):
+        self.marker = marker
+        self.pending = ""
+    
+    def _holdback_start(self, text: str) -> int:
+        """text 末尾需要保留的部分的起始位置"""
+        end = len(text.rstrip())
+        if text.endswith(self.marker, 0, end):
+            start = end - len(self.marker)
+        else:
+            start = end
+            # 末尾没有空白时，可能是标记的前缀
+            if end == len(text):
+                for size in range(min(len(self.marker) - 1, end), 0, -1):
+                    if self.marker.startswith(text[end - size:]):
+                        start = end - size
+                        break
+        return len(text[:start].rstrip())
+    
+    def feed(self, text: str) -> str:
+        """输入一段文本，返回可以输出的部分"""
+        pending = self.pending + text
+        cut = self._holdback_start(pending)
+        self.pending = pending[cut:]
+        return pending[:cut]
+    
+    def finish(self):
+        """一轮结束，返回 (剩余的文本, 是否以完成标记结束)"""
+        pending, self.pending = self.pending, ""
+        if pending.strip() == self.marker:
+            return "", True
+        return pending, False
+
+
+def strip_model_prefix(model: str) -> str:
+    """移除模型名中的模式前缀"""
+    for prefix in [FAKE_STREAM_PREFIX, ANTI_TRUNCATION_PREFIX]:
+        if model.startswith(prefix):
+            model = model[len(prefix):]
+    return model
+
 
 class GeminiClient:
     """Gemini API 客户端 - 直接调用 Google Cloud API"""
@@ -20,78 +95,200 @@ class GeminiClient:
     
     def _clean_model_name(self, model: str) -> str:
         """清理模型名"""
-        # 移除前缀
-        for prefix in ["假流式/", "流式抗截断/"]:
-            if model.startswith(prefix):
-                model = model[len(prefix):]
-        return model
+        return strip_model_prefix(model)
     
-    async def chat_completions(self, model: str, messages: list, **kwargs) -> dict:
-        """非流式聊天补全"""
-        model = self._clean_model_name(model)
-        
-        # 转换 OpenAI 消息格式到 Gemini 格式
-        contents = self._convert_messages(messages)
-        
-        payload = {
+    def _build_payload(self, model: str, messages: list, kwargs: dict) -> dict:
+        """构建请求体"""
+        return {
             "model": model,
             "project": self.project_id,
             "request": {
-                "contents": contents,
+                "contents": self._convert_messages(messages),
                 "generationConfig": self._build_generation_config(kwargs)
             }
         }
+    
+    async def _generate(self, payload: dict) -> dict:
+        """调用非流式 generateContent，返回原始响应"""
+        client = get_google_client()
+        response = await client.post(
+            f"{GOOGLE_API_URL}:generateContent",
+            headers=self._get_headers(),
+            json=payload
+        )
         
-        async with httpx.AsyncClient(timeout=300) as client:
-            response = await client.post(
-                f"{GOOGLE_API_URL}:generateContent",
-                headers=self._get_headers(),
-                json=payload
+        if response.status_code != 200:
+            raise UpstreamError(
+                f"API Error {response.status_code}: {response.text[:500]}",
+                status_code=response.status_code,
+                retry_after=parse_retry_after(response.headers, response.text)
             )
-            
+        
+        return response.json()
+    
+    async def chat_completions(self, model: str, messages: list, **kwargs) -> dict:
+        """非流式聊天补全"""
+        model = self._clean_model_name(model)
+        
+        # 转换 OpenAI 消息格式到 Gemini 格式
+        payload = self._build_payload(model, messages, kwargs)
+        
+        result = await self._generate(payload)
+        return self._convert_to_openai_response(result, model)
+    
+    async def _stream_events(self, payload: dict) -> AsyncGenerator[dict, None]:
+        """调用 streamGenerateContent，逐个产出解析后的 Gemini 流式块"""
+        client = get_google_client()
+        async with client.stream(
+            "POST",
+            f"{GOOGLE_API_URL}:streamGenerateContent?alt=sse",
+            headers=self._get_headers(),
+            json=payload
+        ) as response:
             if response.status_code != 200:
-                raise Exception(f"API Error {response.status_code}: {response.text[:500]}")
+                error = (await response.aread()).decode(errors="replace")
+                raise UpstreamError(
+                    f"API Error {response.status_code}: {error[:500]}",
+                    status_code=response.status_code,
+                    retry_after=parse_retry_after(response.headers, error)
+                )
             
-            result = response.json()
-            return self._convert_to_openai_response(result, model)
+            async for raw in iter_sse_data(response.aiter_bytes()):
+                try:
+                    data = json_loads(raw)
+                except ValueError:
+                    print(f"[Gemini] 无法解析的流式块: {raw[:200]!r}", flush=True)
+                    continue
+                
+                if "error" in data:
+                    error = data["error"]
+                    code = error.get("code") if isinstance(error, dict) else None
+                    raise UpstreamError(
+                        f"API Error {code or ''}: {str(error)[:500]}",
+                        status_code=code if isinstance(code, int) else None,
+                        retry_after=parse_retry_after(None, raw.decode(errors="replace"))
+                    )
+                
+                yield data
     
-    async def chat_completions_stream(self, model: str, messages: list, **kwargs) -> AsyncGenerator[str, None]:
+    async def chat_completions_stream(self, model: str, messages: list, **kwargs) -> AsyncGenerator[bytes, None]:
         """流式聊天补全"""
+        if model.startswith(FAKE_STREAM_PREFIX):
+            async for chunk in self._fake_stream(model, messages, **kwargs):
+                yield chunk
+            return
+        if model.startswith(ANTI_TRUNCATION_PREFIX):
+            async for chunk in self._anti_truncation_stream(model, messages, **kwargs):
+                yield chunk
+            return
+        
         model = self._clean_model_name(model)
+        payload = self._build_payload(model, messages, kwargs)
         
-        contents = self._convert_messages(messages)
+        encoder = ChatChunkEncoder(model)
+        finish_reason = None
         
-        payload = {
-            "model": model,
-            "project": self.project_id,
-            "request": {
-                "contents": contents,
-                "generationConfig": self._build_generation_config(kwargs)
-            }
-        }
+        async for data in self._stream_events(payload):
+            text, reason = extract_gemini_delta(data)
+            if text:
+                yield encoder.delta(text)
+            if reason:
+                finish_reason = reason
         
-        async with httpx.AsyncClient(timeout=300) as client:
-            async with client.stream(
-                "POST",
-                f"{GOOGLE_API_URL}:streamGenerateContent?alt=sse",
-                headers=self._get_headers(),
-                json=payload
-            ) as response:
-                if response.status_code != 200:
-                    error = await response.aread()
-                    raise Exception(f"API Error {response.status_code}: {error.decode()[:500]}")
-                
-                async for line in response.aiter_lines():
-                    if line.startswith("data: "):
-                        try:
-                            data = json.loads(line[6:])
-                            chunk = self._convert_stream_chunk(data, model)
-                            if chunk:
-                                yield f"data: {json.dumps(chunk)}\n\n"
-                        except:
-                            pass
-        
-        yield "data: [DONE]\n\n"
+        yield encoder.finish(FINISH_REASON_MAP.get(finish_reason, "stop"))
+        yield SSE_DONE
+    
+    async def _fake_stream(self, model: str, messages: list, **kwargs) -> AsyncGenerator[bytes, None]:
+        """假流式：一次非流式请求，等待期间发送 SSE 心跳注释，完成后分块输出"""
+        model = self._clean_model_name(model)
+        payload = self._build_payload(model, messages, kwargs)
+        encoder = ChatChunkEncoder(model)
+        
+        task = asyncio.create_task(self._generate(payload))
+        try:
+            while True:
+                done, _ = await asyncio.wait({task}, timeout=settings.fake_stream_heartbeat_interval)
+                if done:
+                    break
+                yield SSE_KEEPALIVE
+            result = task.result()
+        finally:
+            # 客户端断开时取消上游请求，并等待它结束（否则会有 "Task was destroyed but it is pending" 警告）
+            if not task.done():
+                task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await task
+        
+        text, finish_reason = extract_gemini_delta(result)
+        size = max(1, settings.fake_stream_chunk_size)
+        for i in range(0, len(text), size):
+            yield encoder.delta(text[i:i + size])
+        
+        yield encoder.finish(FINISH_REASON_MAP.get(finish_reason, "stop"))
+        yield SSE_DONE
+    
+    async def _anti_truncation_stream(self, model: str, messages: list, **kwargs) -> AsyncGenerator[bytes, None]:
+        """流式抗截断：检测提前结束的流，自动发起续写请求并拼接到同一个 SSE 流
+        
+        判定为截断的情况：finishReason 为 MAX_TOKENS / OTHER、连接中断、
+        或流正常结束但缺少完成标记。
+        """
+        model = self._clean_model_name(model)
+        encoder = ChatChunkEncoder(model)
+        
+        output = []
+        round_messages = list(messages)
+        finish_reason = None
+        truncated = False
+        
+        for round_index in range(settings.anti_truncation_max_rounds + 1):
+            payload = self._build_payload(model, round_messages, kwargs)
+            payload["request"]["systemInstruction"] = {"parts": [{"text": ANTI_TRUNCATION_INSTRUCTION}]}
+            
+            finish_reason = None
+            dropped = False
+            markers = CompletionMarkerFilter()
+            
+            try:
+                async for data in self._stream_events(payload):
+                    text, reason = extract_gemini_delta(data)
+                    if reason:
+                        finish_reason = reason
+                    if not text:
+                        continue
+                    
+                    emit = markers.feed(text)
+                    if emit:
+                        output.append(emit)
+                        yield encoder.delta(emit)
+            except httpx.TransportError as e:
+                # 首轮还没有输出时直接抛出，交给上层处理
+                if not output and not markers.pending:
+                    raise
+                print(f"[Gemini] 抗截断: 第 {round_index + 1} 轮连接中断: {e!r}", flush=True)
+                dropped = True
+            
+            rest, completed = markers.finish()
+            if rest:
+                output.append(rest)
+                yield encoder.delta(rest)
+            
+            truncated = dropped or finish_reason in ("MAX_TOKENS", "OTHER") or (
+                not completed and FINISH_REASON_MAP.get(finish_reason, "stop") == "stop"
+            )
+            if not truncated:
+                break
+            
+            if round_index < settings.anti_truncation_max_rounds:
+                print(f"[Gemini] 抗截断: 检测到截断 (finishReason={finish_reason}, dropped={dropped})，发起续写", flush=True)
+                round_messages = list(messages) + [
+                    {"role": "assistant", "content": "".join(output)},
+                    {"role": "user", "content": ANTI_TRUNCATION_CONTINUE_PROMPT}
+                ]
+        
+        # 达到续写上限仍被截断时，按 length 结束
+        yield encoder.finish("length" if truncated else FINISH_REASON_MAP.get(finish_reason, "stop"))
+        yield SSE_DONE
     
     def _convert_messages(self, messages: list) -> list:
         """将 OpenAI 消息格式转换为 Gemini 格式"""
@@ -159,14 +356,16 @@ class GeminiClient:
         candidates = response_data.get("candidates", [])
         
         content = ""
+        finish_reason = None
         if candidates:
             parts = candidates[0].get("content", {}).get("parts", [])
             content = "".join(p.get("text", "") for p in parts)
+            finish_reason = candidates[0].get("finishReason")
         
         return {
-            "id": f"chatcmpl-{id(result)}",
+            "id": new_completion_id(),
             "object": "chat.completion",
-            "created": 0,
+            "created": int(time.time()),
             "model": model,
             "choices": [{
                 "index": 0,
@@ -174,7 +373,7 @@ class GeminiClient:
                     "role": "assistant",
                     "content": content
                 },
-                "finish_reason": "stop"
+                "finish_reason": FINISH_REASON_MAP.get(finish_reason, "stop")
             }],
             "usage": {
                 "prompt_tokens": 0,
@@ -182,31 +381,3 @@ class GeminiClient:
                 "total_tokens": 0
             }
         }
-    
-    def _convert_stream_chunk(self, data: dict, model: str) -> Optional[dict]:
-        """将 Gemini 流式块转换为 OpenAI 格式"""
-        response_data = data.get("response", data)
-        candidates = response_data.get("candidates", [])
-        
-        if not candidates:
-            return None
-        
-        parts = candidates[0].get("content", {}).get("parts", [])
-        text = "".join(p.get("text", "") for p in parts)
-        
-        if not text:
-            return None
-        
-        return {
-            "id": f"chatcmpl-{id(data)}",
-            "object": "chat.completion.chunk",
-            "created": 0,
-            "model": model,
-            "choices": [{
-                "index": 0,
-                "delta": {
-                    "content": text
-                },
-                "finish_reason": None
-            }]
-        }
@@ -0,0 +1,38 @@
+from collections import deque
+from typing import Deque, Dict
+
+from app.config import settings
+
+
+class LatencyTracker:
+    """按模型记录最近的非流式请求延迟，用于计算对冲请求的触发延迟"""
+
+    def __init__(self):
+        self._samples: Dict[str, Deque[float]] = {}
+
+    def observe(self, model: str, seconds: float):
+        """记录一次成功请求的延迟"""
+        samples = self._samples.get(model)
+        if samples is None:
+            samples = deque(maxlen=settings.hedge_window)
+            self._samples[model] = samples
+        samples.append(seconds)
+
+    def percentile(self, model: str, p: float) -> float:
+        """返回延迟的 p 分位数，样本不足时返回 -1"""
+        samples = self._samples.get(model)
+        if not samples or len(samples) < settings.hedge_min_samples:
+            return -1.0
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(len(ordered) * p / 100))
+        return ordered[index]
+
+    def hedge_delay(self, model: str) -> float:
+        """对冲请求的触发延迟（秒）"""
+        delay = self.percentile(model, settings.hedge_percentile)
+        if delay < 0:
+            delay = settings.hedge_initial_delay
+        return min(settings.hedge_max_delay, max(settings.hedge_min_delay, delay))
+
+
+latency_tracker = LatencyTracker()
@@ -0,0 +1,118 @@
+import asyncio
+import httpx
+from typing import Dict, Optional
+
+from app.config import settings
+
+
+class UpstreamBusyError(Exception):
+    """上游并发槽位已满"""
+
+
+# 进程级共享的上游客户端，由 main.py 的 lifespan 创建和关闭
+_google_client: Optional[httpx.AsyncClient] = None
+_antigravity_client: Optional[httpx.AsyncClient] = None
+
+# 每个上游地址的并发信号量
+_upstream_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+
+def _build_timeout() -> httpx.Timeout:
+    """构建上游超时配置"""
+    return httpx.Timeout(
+        settings.upstream_read_timeout,
+        connect=settings.upstream_connect_timeout
+    )
+
+
+def _build_limits() -> httpx.Limits:
+    """构建上游连接池限制"""
+    return httpx.Limits(
+        max_connections=settings.upstream_max_connections,
+        max_keepalive_connections=settings.upstream_max_keepalive_connections,
+        keepalive_expiry=settings.upstream_keepalive_expiry
+    )
+
+
+def _create_google_client() -> httpx.AsyncClient:
+    """创建 Google API 客户端"""
+    http2 = settings.upstream_http2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            print("[HTTP] 未安装 h2，回退到 HTTP/1.1", flush=True)
+            http2 = False
+
+    return httpx.AsyncClient(
+        http2=http2,
+        timeout=_build_timeout(),
+        limits=_build_limits()
+    )
+
+
+def _create_antigravity_client() -> httpx.AsyncClient:
+    """创建 Antigravity 服务客户端"""
+    return httpx.AsyncClient(
+        timeout=_build_timeout(),
+        limits=httpx.Limits(
+            max_connections=settings.antigravity_max_connections,
+            max_keepalive_connections=settings.antigravity_max_keepalive_connections,
+            keepalive_expiry=settings.antigravity_keepalive_expiry
+        )
+    )
+
+
+async def init_http_clients():
+    """初始化共享 HTTP 客户端"""
+    global _google_client, _antigravity_client
+    if _google_client is None:
+        _google_client = _create_google_client()
+    if _antigravity_client is None:
+        _antigravity_client = _create_antigravity_client()
+    print("[HTTP] 上游连接池已创建", flush=True)
+
+
+async def close_http_clients():
+    """关闭共享 HTTP 客户端"""
+    global _google_client, _antigravity_client
+    if _google_client is not None:
+        await _google_client.aclose()
+        _google_client = None
+    if _antigravity_client is not None:
+        await _antigravity_client.aclose()
+        _antigravity_client = None
+
+
+def get_google_client() -> httpx.AsyncClient:
+    """获取 Google API 共享客户端（未初始化时按需创建）"""
+    global _google_client
+    if _google_client is None:
+        _google_client = _create_google_client()
+    return _google_client
+
+
+def get_antigravity_client() -> httpx.AsyncClient:
+    """获取 Antigravity 服务共享客户端（未初始化时按需创建）"""
+    global _antigravity_client
+    if _antigravity_client is None:
+        _antigravity_client = _create_antigravity_client()
+    return _antigravity_client
+
+
+async def acquire_upstream_slot(base: str):
+    """获取上游并发槽位，超时抛出 UpstreamBusyError"""
+    semaphore = _upstream_semaphores.get(base)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(settings.antigravity_max_concurrency)
+        _upstream_semaphores[base] = semaphore
+
+    try:
+        await asyncio.wait_for(semaphore.acquire(), timeout=settings.antigravity_queue_timeout)
+    except asyncio.TimeoutError:
+        raise UpstreamBusyError(f"上游 {base} 并发已满")
+
+
+def release_upstream_slot(base: str):
+    """释放上游并发槽位"""
+    _upstream_semaphores[base].release()
@@ -0,0 +1,119 @@
+import asyncio
+import hashlib
+from datetime import datetime, time, timedelta
+from typing import Optional, Tuple
+
+from sqlalchemy import func, select
+
+from app.config import settings
+from app.services.sse import json_dumps
+from app.services.usage_writer import usage_writer
+
+
+EMPTY_STATS = {
+    "users": 0,
+    "tokens": {"total": 0, "valid": 0, "invalid": 0, "claude": 0, "gemini": 0},
+    "today_requests": 0,
+    "total_requests": 0
+}
+
+
+def _encode(stats: dict) -> Tuple[bytes, str]:
+    body = json_dumps(stats)
+    return body, '"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+
+
+class PublicStats:
+    """/api/public/stats 的快照
+
+    统计在后台每 public_stats_interval 秒重新计算一次，接口只返回内存中
+    预先序列化好的结果和 ETag，匿名请求不会触发数据库查询（还没算出过快照时返回全 0）。
+    总请求数每 public_stats_recount_interval 秒完整计数一次，两次计数之间加上
+    usage_writer 写入的条数。
+    """
+
+    def __init__(self):
+        self.body, self.etag = _encode(EMPTY_STATS)
+        self._runner: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        self._total: Optional[int] = None
+        self._written = 0
+        self._counted_at = 0.0
+
+    async def _total_requests(self, db) -> int:
+        """总请求数：定期完整计数，之间加上本进程写入的条数（其他 worker 的写入和删除在下次计数时修正）"""
+        from app.models.user import UsageLog
+
+        now = asyncio.get_running_loop().time()
+        if self._total is None or now - self._counted_at >= settings.public_stats_recount_interval:
+            self._total = await db.scalar(select(func.count(UsageLog.id))) or 0
+            self._written = usage_writer.written
+            self._counted_at = now
+        return self._total + usage_writer.written - self._written
+
+    async def _compute(self) -> dict:
+        from app.database import async_session
+        from app.models.user import User, UsageLog
+        from app.services.token_pool import TokenPool
+
+        today = datetime.combine(datetime.utcnow().date(), time.min)
+        async with async_session() as db:
+            # 用户数
+            user_count = await db.scalar(select(func.count(User.id))) or 0
+
+            # Token 池统计
+            pool_stats = await TokenPool.get_pool_stats(db)
+
+            # 今日请求数（UTC，created_at 索引上的范围查询）
+            today_requests = await db.scalar(
+                select(func.count(UsageLog.id)).where(
+                    UsageLog.created_at >= today,
+                    UsageLog.created_at < today + timedelta(days=1)
+                )
+            ) or 0
+
+            total_requests = await self._total_requests(db)
+
+        return {
+            "users": user_count,
+            "tokens": pool_stats,
+            "today_requests": today_requests,
+            "total_requests": total_requests
+        }
+
+    async def refresh(self):
+        """重新计算快照"""
+        async with self._lock:
+            self.body, self.etag = _encode(await self._compute())
+
+    def get(self) -> Tuple[bytes, str]:
+        """返回 (body, etag)"""
+        return self.body, self.etag
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(settings.public_stats_interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"[Stats] 计算公开统计失败: {e}", flush=True)
+
+    async def start(self):
+        if self._runner is None:
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"[Stats] 计算公开统计失败: {e}", flush=True)
+            self._runner = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._runner is not None:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
+
+
+public_stats = PublicStats()
@@ -0,0 +1,77 @@
+from datetime import date, datetime, time, timedelta
+from typing import Optional, Set, Tuple
+
+from sqlalchemy import func, or_, select
+
+
+def utc_today() -> date:
+    return datetime.utcnow().date()
+
+
+class QuotaTracker:
+    """每日配额计数
+
+    每次请求在 quota_counters 表中原子地占用一次配额
+    （INSERT ... ON CONFLICT DO UPDATE SET count = count + 1 WHERE count < 上限 RETURNING count），
+    多个 worker 共享同一份计数，并发请求不会越过 daily_quota。
+    某个用户当天还没有计数行时，按 usage_logs 推算一次初始值（不含对冲请求额外的调用）。
+    """
+
+    def __init__(self):
+        # 已确认有计数行的 (用户, 日期)，不用再推算初始值
+        self._known: Set[Tuple[int, date]] = set()
+        self._day: Optional[date] = None
+
+    async def _seed(self, db, user_id: int, day: date) -> int:
+        """计数行不存在时，从 usage_logs 推算当天已有的请求数"""
+        from app.models.user import QuotaCounter, UsageLog
+        from app.services.usage_writer import HEDGE_ERROR_PREFIX
+
+        count = await db.scalar(
+            select(QuotaCounter.count).where(QuotaCounter.user_id == user_id, QuotaCounter.day == day)
+        )
+        if count is not None:
+            return 0
+        start = datetime.combine(day, time.min)
+        count = await db.scalar(
+            select(func.count(UsageLog.id)).where(
+                UsageLog.user_id == user_id,
+                UsageLog.created_at >= start,
+                UsageLog.created_at < start + timedelta(days=1),
+                # 对冲请求额外的上游调用不占用配额
+                or_(UsageLog.error_message.is_(None), ~UsageLog.error_message.startswith(HEDGE_ERROR_PREFIX))
+            )
+        )
+        return count or 0
+
+    async def consume(self, user_id: int, limit: int) -> Optional[int]:
+        """占用一次配额，返回占用后的当日用量；已达上限时返回 None"""
+        from app.database import async_session, upsert_insert
+        from app.models.user import QuotaCounter
+
+        day = utc_today()
+        if day != self._day:
+            # 过了零点后丢弃前一天的记录
+            self._known.clear()
+            self._day = day
+        key = (user_id, day)
+
+        async with async_session() as db:
+            seed = 0 if key in self._known else await self._seed(db, user_id, day)
+            statement = upsert_insert(QuotaCounter).values(
+                user_id=user_id, day=day, count=seed + 1
+            ).on_conflict_do_update(
+                index_elements=[QuotaCounter.user_id, QuotaCounter.day],
+                set_={"count": QuotaCounter.count + 1},
+                where=QuotaCounter.count < limit
+            ).returning(QuotaCounter.count)
+            count = await db.scalar(statement)
+            await db.commit()
+
+        self._known.add(key)
+        if count is None or count > limit:
+            return None
+        return count
+
+
+quota_tracker = QuotaTracker()
@@ -0,0 +1,132 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from app.config import settings
+
+
+# 令牌桶（Redis 版）：KEYS[1] 为桶，ARGV 为 每秒补充的令牌数、桶容量；返回需要等待的秒数
+_REDIS_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local data = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(data[1]) or capacity
+local ts = tonumber(data[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+
+class _Bucket:
+    __slots__ = ("tokens", "updated", "rpm")
+
+    def __init__(self, rpm: int, now: float):
+        self.tokens = float(rpm)
+        self.updated = now
+        self.rpm = rpm
+
+
+class RateLimiter:
+    """按用户的令牌桶限流（每分钟请求数）
+
+    桶容量为 rpm，每秒补充 rpm/60 个令牌；用户档位变化时保留桶中剩余的令牌
+    （不超过新的容量），切换档位不能重置限额。默认保存在进程内：闲置到已经
+    补满的桶会被定期清理，桶数量超过 rate_limit_max_buckets 时淘汰最久
+    未使用的。配置 rate_limit_redis_url 时改用 Redis 保存，多个 worker
+    共享同一个限额；Redis 不可用时临时回退到进程内的桶。
+    """
+
+    def __init__(self):
+        self._buckets: "OrderedDict[int, _Bucket]" = OrderedDict()
+        self._redis = None
+        self._script = None
+        self._sweeper: Optional[asyncio.Task] = None
+
+    def _acquire_local(self, user_id: int, rpm: int) -> float:
+        now = time.monotonic()
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = _Bucket(rpm, now)
+            while len(self._buckets) > settings.rate_limit_max_buckets:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_id)
+            # 按原来的速率补充到现在；档位变化（rpm 不同）时保留剩余令牌，不超过新的容量
+            bucket.tokens = min(float(bucket.rpm), bucket.tokens + (now - bucket.updated) * bucket.rpm / 60)
+            bucket.tokens = min(float(rpm), bucket.tokens)
+            bucket.rpm = rpm
+            bucket.updated = now
+
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            return 0.0
+        return (1 - bucket.tokens) * 60 / rpm
+
+    async def acquire(self, user_id: int, rpm: int) -> float:
+        """消耗一个令牌；返回 0 表示放行，否则返回需要等待的秒数"""
+        if rpm <= 0:
+            return 0.0
+        if self._script is not None:
+            try:
+                wait = await self._script(keys=[f"ratelimit:{user_id}"], args=[rpm / 60, rpm])
+                return float(wait)
+            except Exception as e:
+                print(f"[RateLimit] Redis 不可用，使用本地限流: {e}", flush=True)
+        return self._acquire_local(user_id, rpm)
+
+    def sweep(self):
+        """清理已经补满的桶（与新建的桶等价）"""
+        now = time.monotonic()
+        for user_id in [
+            user_id for user_id, bucket in self._buckets.items()
+            if bucket.tokens + (now - bucket.updated) * bucket.rpm / 60 >= bucket.rpm
+        ]:
+            del self._buckets[user_id]
+
+    def __len__(self):
+        return len(self._buckets)
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(60)
+            self.sweep()
+
+    async def start(self):
+        if settings.rate_limit_redis_url and self._redis is None:
+            try:
+                import redis.asyncio as redis
+            except ImportError:
+                print("[RateLimit] 未安装 redis，使用本地限流", flush=True)
+            else:
+                self._redis = redis.from_url(settings.rate_limit_redis_url)
+                self._script = self._redis.register_script(_REDIS_SCRIPT)
+                print("[RateLimit] 使用 Redis 共享限流", flush=True)
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def stop(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+            self._sweeper = None
+        if self._redis is not None:
+            await self._redis.aclose()
+            self._redis = None
+            self._script = None
+
+
+rate_limiter = RateLimiter()
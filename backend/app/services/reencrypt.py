@@ -0,0 +1,126 @@
+import asyncio
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import bindparam, func, select, update
+
+from app.config import settings
+from app.services.crypto import get_encryption_secrets, is_primary_encrypted, rotate_token
+from app.services.token_index import token_index
+from app.services.token_pool import credential_cache
+
+
+class ReencryptJob:
+    """后台重新加密 tokens 表（密钥轮换后使用）
+
+    按 id 做 keyset 分页，每批最多 reencrypt_batch_size 行、一个短事务，
+    批次之间暂停 reencrypt_batch_delay 秒，不会长时间锁住数据库。
+    写回时比较旧密文，期间被刷新过的 token 不会被覆盖。
+    """
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._status = {"state": "idle"}
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def status(self) -> dict:
+        return dict(self._status)
+
+    def start(self) -> bool:
+        """启动任务，已经在运行时返回 False"""
+        if self.running:
+            return False
+        self._status = {
+            "state": "running",
+            "keys": len(get_encryption_secrets()),
+            "total": None,
+            "processed": 0,
+            "rotated": 0,
+            "failed": 0,
+            "last_id": 0,
+            "started_at": datetime.utcnow().isoformat(),
+            "finished_at": None,
+            "error": None,
+        }
+        self._task = asyncio.create_task(self._run())
+        return True
+
+    async def _run(self):
+        from app.database import async_session
+        from app.models.user import Token
+
+        status = self._status
+        tokens = Token.__table__
+        statement = update(tokens).where(
+            tokens.c.id == bindparam("token_id"),
+            tokens.c.token == bindparam("old_token")
+        ).values(token=bindparam("new_token"))
+
+        try:
+            async with async_session() as db:
+                status["total"] = await db.scalar(select(func.count(Token.id)))
+
+            last_id = 0
+            while True:
+                async with async_session() as db:
+                    result = await db.execute(
+                        select(Token.id, Token.token).where(Token.id > last_id)
+                        .order_by(Token.id).limit(settings.reencrypt_batch_size)
+                    )
+                    rows = result.all()
+                    if not rows:
+                        break
+
+                    changes = []
+                    for token_id, ciphertext in rows:
+                        try:
+                            if not is_primary_encrypted(ciphertext):
+                                changes.append({
+                                    "token_id": token_id,
+                                    "old_token": ciphertext,
+                                    "new_token": rotate_token(ciphertext),
+                                })
+                        except Exception as e:
+                            status["failed"] += 1
+                            print(f"[Reencrypt] Token #{token_id} 无法解密: {e}", flush=True)
+
+                    if changes:
+                        await db.execute(statement, changes)
+                        await db.commit()
+
+                for change in changes:
+                    entry = token_index.get(change["token_id"])
+                    if entry is not None and entry.token == change["old_token"]:
+                        token_index.update_ciphertext(change["token_id"], change["new_token"])
+                    credential_cache.invalidate(change["token_id"])
+
+                last_id = rows[-1][0]
+                status["last_id"] = last_id
+                status["processed"] += len(rows)
+                status["rotated"] += len(changes)
+                await asyncio.sleep(settings.reencrypt_batch_delay)
+
+            status["state"] = "done"
+            print(f"[Reencrypt] 完成: 共 {status['processed']} 个，重新加密 {status['rotated']} 个，"
+                  f"失败 {status['failed']} 个", flush=True)
+        except Exception as e:
+            status["state"] = "failed"
+            status["error"] = str(e)
+            print(f"[Reencrypt] 中断: {e}", flush=True)
+        finally:
+            status["finished_at"] = datetime.utcnow().isoformat()
+
+    async def stop(self):
+        if self.running:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._status["state"] = "cancelled"
+
+
+reencrypt_job = ReencryptJob()
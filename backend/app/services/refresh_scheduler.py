@@ -0,0 +1,170 @@
+import asyncio
+import heapq
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import update
+
+from app.config import settings
+from app.services.cooldown import cooldown_queue
+from app.services.crypto import encrypt_token
+from app.services.token_index import token_index
+from app.services.token_pool import TokenPool, credential_cache
+
+
+class RefreshScheduler:
+    """OAuth access_token 后台刷新
+
+    按 expires_at 维护最小堆，在过期前 oauth_refresh_margin 秒主动刷新，
+    并发数受 oauth_refresh_concurrency 限制。同一个 token 同一时间只有一个
+    刷新在进行，并发的调用方共享同一个结果。刷新失败后 oauth_refresh_retry_delay 秒内
+    请求触发的刷新直接返回失败（由后台按计划重试），token 同时在 Gemini 上冷却，
+    不会被每个请求和每次故障转移反复拿去请求 Google。
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[int, int]] = []
+        self._scheduled: Dict[int, int] = {}
+        self._inflight: Dict[int, asyncio.Future] = {}
+        # 最近刷新失败的 token -> 可以再次由请求触发刷新的时间（monotonic）
+        self._failed: Dict[int, float] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._runner: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+
+    def schedule(self, token_id: int, expires_at: int):
+        """安排 token 在过期前刷新"""
+        if expires_at <= 0:
+            return
+        self._scheduled[token_id] = expires_at
+        heapq.heappush(self._heap, (expires_at, token_id))
+        # 新条目排在最前面时唤醒调度循环
+        if self._heap[0] == (expires_at, token_id):
+            self._wakeup.set()
+
+    def scan(self):
+        """把索引中还没有安排刷新的 token 加入堆"""
+        for entry in token_index.entries():
+            if entry.id in self._scheduled:
+                continue
+            try:
+                token_data = TokenPool.get_credentials(entry)
+            except Exception as e:
+                print(f"[Refresh] Token #{entry.id} 解密失败: {e}", flush=True)
+                continue
+            if token_data["refresh_token"]:
+                self.schedule(entry.id, token_data["expires_at"])
+
+    async def refresh(self, token_id: int, background: bool = False) -> Optional[str]:
+        """刷新 token 并返回新的 access_token（single-flight）；最近刷新失败过时直接返回 None"""
+        if not background:
+            retry_at = self._failed.get(token_id)
+            if retry_at is not None:
+                if retry_at > time.monotonic():
+                    return None
+                del self._failed[token_id]
+        future = self._inflight.get(token_id)
+        if future is None:
+            future = asyncio.ensure_future(self._refresh(token_id))
+            self._inflight[token_id] = future
+            future.add_done_callback(lambda _: self._inflight.pop(token_id, None))
+        # 调用方被取消时不影响共享的刷新
+        return await asyncio.shield(future)
+
+    async def _refresh(self, token_id: int) -> Optional[str]:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(settings.oauth_refresh_concurrency)
+
+        async with self._semaphore:
+            entry = token_index.get(token_id)
+            if entry is None:
+                return None
+
+            token_data = TokenPool.get_credentials(entry)
+            refresh_token = token_data["refresh_token"]
+            now = int(time.time())
+
+            # 排队期间可能已经被刷新过
+            if token_data["expires_at"] - now > settings.oauth_refresh_margin:
+                return token_data["access_token"]
+            if not refresh_token:
+                return token_data["access_token"]
+
+            print(f"[Refresh] Token #{token_id} 刷新中...", flush=True)
+            new_token_data = await TokenPool.refresh_access_token(refresh_token)
+            if not new_token_data:
+                print(f"[Refresh] Token #{token_id} 刷新失败", flush=True)
+                # 稍后由后台再试，在此之前请求不再触发刷新
+                delay = settings.oauth_refresh_retry_delay
+                self._failed[token_id] = time.monotonic() + delay
+                cooldown_queue.park(token_id, "gemini", delay, "Token 刷新失败")
+                self.schedule(token_id, now + settings.oauth_refresh_margin + delay)
+                return None
+
+            new_access = new_token_data["access_token"]
+            new_expires_at = now + new_token_data["expires_in"]
+            ciphertext = encrypt_token(f"{new_access}|||{refresh_token}|||{new_expires_at}")
+
+            from app.database import async_session
+            from app.models.user import Token
+
+            async with async_session() as db:
+                await db.execute(update(Token).where(Token.id == token_id).values(token=ciphertext))
+                await db.commit()
+
+            token_index.update_ciphertext(token_id, ciphertext)
+            credential_cache.invalidate(token_id)
+            self._failed.pop(token_id, None)
+            self.schedule(token_id, new_expires_at)
+            print(f"[Refresh] Token #{token_id} 刷新成功", flush=True)
+            return new_access
+
+    def _spawn(self, token_id: int):
+        task = asyncio.create_task(self.refresh(token_id, background=True))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self):
+        last_scan = 0.0
+        while True:
+            now = time.time()
+            if now - last_scan >= settings.oauth_refresh_scan_interval:
+                self.scan()
+                last_scan = now
+
+            margin = settings.oauth_refresh_margin
+            while self._heap and self._heap[0][0] - margin <= now:
+                expires_at, token_id = heapq.heappop(self._heap)
+                # 被重新安排过的旧条目直接丢弃
+                if self._scheduled.get(token_id) != expires_at:
+                    continue
+                del self._scheduled[token_id]
+                self._spawn(token_id)
+
+            delay = settings.oauth_refresh_scan_interval - (now - last_scan)
+            if self._heap:
+                delay = min(delay, self._heap[0][0] - margin - now)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=min(max(delay, 1.0), 30.0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def start(self):
+        if self._runner is None:
+            self._runner = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._runner is not None:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
+        for task in list(self._tasks):
+            task.cancel()
+
+
+refresh_scheduler = RefreshScheduler()
@@ -0,0 +1,67 @@
+import asyncio
+import httpx
+import random
+from typing import Optional
+
+from app.config import settings
+
+
+class UpstreamError(Exception):
+    """上游返回的错误"""
+
+    def __init__(
+        self,
+        message: str,
+        status_code: Optional[int] = None,
+        retryable: Optional[bool] = None,
+        retry_after: Optional[float] = None
+    ):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after  # 上游给出的冷却时间（秒）
+        if retryable is None:
+            retryable = status_code is not None and (status_code == 429 or status_code >= 500)
+        self.retryable = retryable
+
+
+# 连接阶段的错误：请求一定没有到达上游，任何时候都可以重试
+_CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+def is_retryable(exc: Exception, before_first_byte: bool = False) -> bool:
+    """判断错误是否可以换 token 重试"""
+    if isinstance(exc, UpstreamError):
+        return exc.retryable
+    if isinstance(exc, _CONNECT_ERRORS):
+        return True
+    # 还没有向客户端输出任何内容时，传输错误也可以重试
+    if before_first_byte and isinstance(exc, httpx.TransportError):
+        return True
+    return False
+
+
+class RetryBudget:
+    """单个请求的重试预算：尝试次数 + 截止时间 + 抖动退避"""
+
+    def __init__(self):
+        loop = asyncio.get_running_loop()
+        self._loop = loop
+        self.deadline = loop.time() + settings.retry_deadline
+        self.attempts = 1
+
+    def remaining(self) -> float:
+        return self.deadline - self._loop.time()
+
+    def next_attempt(self) -> bool:
+        """消耗一次尝试机会，预算耗尽时返回 False"""
+        if self.attempts >= settings.retry_max_attempts or self.remaining() <= 0:
+            return False
+        self.attempts += 1
+        return True
+
+    async def backoff(self, retry_after: Optional[float] = None):
+        """Full jitter 指数退避，不超过剩余时间；重试同一个上游时至少等待上游给出的 retry_after"""
+        cap = min(settings.retry_backoff_max, settings.retry_backoff_base * (2 ** (self.attempts - 2)))
+        delay = min(max(random.uniform(0, cap), retry_after or 0.0), max(0.0, self.remaining()))
+        if delay > 0:
+            await asyncio.sleep(delay)
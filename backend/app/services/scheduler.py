@@ -0,0 +1,127 @@
+import random
+from typing import Callable, Dict, List, Optional, Set
+
+from app.config import settings
+
+
+class TokenStats:
+    """单个 token 的实时负载和健康状态"""
+
+    __slots__ = ("in_flight", "latency", "success_rate", "cancelled")
+
+    def __init__(self):
+        self.in_flight = 0
+        self.latency = 0.0          # EWMA 延迟（秒），0 表示还没有样本
+        self.success_rate = 1.0     # EWMA 成功率
+        self.cancelled = 0          # 被取消的尝试次数（例如对冲请求中落后的一方）
+
+
+def _sample(candidates: List[int], exclude: Optional[Set[int]], k: int) -> List[int]:
+    """从候选中随机取最多 k 个不在 exclude 中的 token"""
+    picked = []
+    if exclude:
+        # 先随机试几次，排除的 token 很多时再退回到过滤
+        for _ in range(4 * k):
+            token_id = random.choice(candidates)
+            if token_id not in exclude and token_id not in picked:
+                picked.append(token_id)
+                if len(picked) == k:
+                    return picked
+        pool = [i for i in candidates if i not in exclude and i not in picked]
+        return picked + random.sample(pool, min(k - len(picked), len(pool)))
+    if len(candidates) <= k:
+        return list(candidates)
+    return random.sample(candidates, k)
+
+
+class TokenScheduler:
+    """Token 选择策略
+
+    - random: 随机选择
+    - p2c: 随机取两个，选择在途请求较少的（power of two choices）
+    - ewma: 随机取两个，按 EWMA 延迟 × (在途请求 + 1) / 成功率 选择代价较低的
+    """
+
+    def __init__(self):
+        self._stats: Dict[int, TokenStats] = {}
+        self._strategies: Dict[str, Callable[[List[int]], int]] = {
+            "random": self._pick_random,
+            "p2c": self._pick_least_in_flight,
+            "ewma": self._pick_ewma,
+        }
+
+    def stats(self, token_id: int) -> TokenStats:
+        stats = self._stats.get(token_id)
+        if stats is None:
+            stats = self._stats[token_id] = TokenStats()
+        return stats
+
+    def forget(self, token_id: int):
+        """token 被删除或禁用后丢弃它的统计"""
+        self._stats.pop(token_id, None)
+
+    def register(self, name: str, strategy: Callable[[List[int]], int]):
+        """注册自定义策略：接收两个（或更少）候选 token id，返回选中的 id"""
+        self._strategies[name] = strategy
+
+    def select(self, candidates: List[int], exclude: Optional[Set[int]] = None) -> Optional[int]:
+        """按配置的策略从候选中选择一个 token"""
+        if not candidates:
+            return None
+        sampled = _sample(candidates, exclude, 2)
+        if not sampled:
+            return None
+        if len(sampled) == 1:
+            return sampled[0]
+        strategy = self._strategies.get(settings.token_select_strategy, self._pick_least_in_flight)
+        return strategy(sampled)
+
+    def _pick_random(self, sampled: List[int]) -> int:
+        return sampled[0]
+
+    def _pick_least_in_flight(self, sampled: List[int]) -> int:
+        return min(sampled, key=lambda i: self.stats(i).in_flight)
+
+    def _cost(self, token_id: int) -> float:
+        stats = self.stats(token_id)
+        # 没有样本的 token 按默认延迟估计，让新 token 也能分到流量
+        latency = stats.latency or settings.scheduler_default_latency
+        return latency * (stats.in_flight + 1) / max(stats.success_rate, 0.05)
+
+    def _pick_ewma(self, sampled: List[int]) -> int:
+        return min(sampled, key=self._cost)
+
+    def acquire(self, token_id: int):
+        """请求开始"""
+        self.stats(token_id).in_flight += 1
+
+    def release(
+        self,
+        token_id: int,
+        latency: Optional[float] = None,
+        success: Optional[bool] = None,
+        cancelled: bool = False
+    ):
+        """请求结束；latency / success 为 None 时（例如客户端断开）不更新健康状态
+
+        cancelled 表示尝试被主动取消，latency 为取消前已经等待的时间：
+        真实延迟至少是这么久，只在它高于当前估计时把 EWMA 延迟往上调。
+        """
+        stats = self._stats.get(token_id)
+        if stats is None:
+            # 请求进行中 token 被删除或禁用，统计已经丢弃
+            return
+        stats.in_flight = max(0, stats.in_flight - 1)
+        alpha = settings.scheduler_ewma_alpha
+        if cancelled:
+            stats.cancelled += 1
+            if latency is not None and latency > stats.latency:
+                stats.latency = latency if stats.latency == 0 else stats.latency + alpha * (latency - stats.latency)
+            return
+        if success is not None:
+            stats.success_rate += alpha * ((1.0 if success else 0.0) - stats.success_rate)
+        if success and latency is not None:
+            stats.latency = latency if stats.latency == 0 else stats.latency + alpha * (latency - stats.latency)
+
+
+token_scheduler = TokenScheduler()
@@ -0,0 +1,115 @@
+import json
+import time
+import uuid
+from typing import AsyncIterator, AsyncGenerator, Optional, Tuple
+
+# JSON 后端：优先使用 orjson，未安装时回退到标准库
+try:
+    import orjson
+
+    json_loads = orjson.loads
+
+    def json_dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+
+    JSON_BACKEND = "orjson"
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+    JSON_BACKEND = "json"
+
+
+SSE_DONE = b"data: [DONE]\n\n"
+SSE_KEEPALIVE = b": keepalive\n\n"
+
+# Gemini finishReason -> OpenAI finish_reason
+FINISH_REASON_MAP = {
+    "STOP": "stop",
+    "MAX_TOKENS": "length",
+    "SAFETY": "content_filter",
+    "RECITATION": "content_filter",
+    "PROHIBITED_CONTENT": "content_filter",
+    "BLOCKLIST": "content_filter",
+    "SPII": "content_filter",
+}
+
+
+def new_completion_id() -> str:
+    """生成 chatcmpl id"""
+    return f"chatcmpl-{uuid.uuid4().hex[:24]}"
+
+
+async def iter_sse_data(byte_stream: AsyncIterator[bytes]) -> AsyncGenerator[bytes, None]:
+    """在字节层面切分 SSE 行，产出每个 data: 行的负载（不解码为 str）"""
+    buffer = bytearray()
+    async for chunk in byte_stream:
+        buffer += chunk
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end < 0:
+                break
+            line = bytes(buffer[start:end]).rstrip(b"\r")
+            start = end + 1
+            if line.startswith(b"data:"):
+                payload = line[5:].lstrip()
+                if payload:
+                    yield payload
+        if start:
+            del buffer[:start]
+
+    # 处理末尾没有换行的残留数据
+    line = bytes(buffer).strip()
+    if line.startswith(b"data:"):
+        payload = line[5:].lstrip()
+        if payload:
+            yield payload
+
+
+def extract_gemini_delta(data: dict) -> Tuple[str, Optional[str]]:
+    """从 Gemini 流式块中提取文本和 finishReason"""
+    response_data = data.get("response", data)
+    candidates = response_data.get("candidates")
+    if not candidates:
+        return "", None
+
+    candidate = candidates[0]
+    parts = candidate.get("content", {}).get("parts", [])
+    if len(parts) == 1:
+        text = parts[0].get("text", "")
+    else:
+        text = "".join(p.get("text", "") for p in parts)
+    return text, candidate.get("finishReason")
+
+
+class ChatChunkEncoder:
+    """OpenAI chat.completion.chunk 编码器
+
+    信封在创建时预先序列化，每个块只需拼接 delta 文本的 JSON 字符串。
+    同一个流内 id 和 created 保持不变。
+    """
+
+    def __init__(self, model: str):
+        self.id = new_completion_id()
+        self.created = int(time.time())
+        head = (
+            b'{"id":' + json_dumps(self.id)
+            + b',"object":"chat.completion.chunk","created":' + str(self.created).encode()
+            + b',"model":' + json_dumps(model)
+            + b',"choices":[{"index":0,'
+        )
+        self._delta_prefix = b"data: " + head + b'"delta":{"content":'
+        self._delta_suffix = b'},"finish_reason":null}]}\n\n'
+        self._finish_prefix = b"data: " + head + b'"delta":{},"finish_reason":'
+        self._finish_suffix = b"}]}\n\n"
+
+    def delta(self, text: str) -> bytes:
+        """编码一个内容增量块"""
+        return self._delta_prefix + json_dumps(text) + self._delta_suffix
+
+    def finish(self, finish_reason: Optional[str] = "stop") -> bytes:
+        """编码结束块"""
+        return self._finish_prefix + json_dumps(finish_reason) + self._finish_suffix
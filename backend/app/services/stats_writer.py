@@ -0,0 +1,118 @@
+import asyncio
+from datetime import datetime
+from typing import Dict, Optional
+
+from sqlalchemy import DateTime, Integer, String, bindparam, func, update
+
+from app.config import settings
+
+
+class _TokenDelta:
+    __slots__ = ("success", "failure", "last_used", "last_error")
+
+    def __init__(self):
+        self.success = 0
+        self.failure = 0
+        self.last_used: Optional[datetime] = None
+        self.last_error: Optional[str] = None
+
+
+class TokenStatsBuffer:
+    """Token 成功/失败计数的写回缓冲
+
+    计数增量、last_used 和 last_error 先在内存中累积，
+    每 stats_flush_interval 秒（或累积的 token 数达到 stats_flush_threshold 时）
+    在一个事务中批量 UPDATE，关闭时再刷一次。
+    """
+
+    def __init__(self):
+        self._pending: Dict[int, _TokenDelta] = {}
+        self._wakeup = asyncio.Event()
+        self._runner: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    def _delta(self, token_id: int) -> _TokenDelta:
+        delta = self._pending.get(token_id)
+        if delta is None:
+            delta = self._pending[token_id] = _TokenDelta()
+            if len(self._pending) >= settings.stats_flush_threshold:
+                self._wakeup.set()
+        return delta
+
+    def record_success(self, token_id: int):
+        delta = self._delta(token_id)
+        delta.success += 1
+        delta.last_used = datetime.utcnow()
+        delta.last_error = None
+
+    def record_failure(self, token_id: int, error: Optional[str]):
+        delta = self._delta(token_id)
+        delta.failure += 1
+        delta.last_error = error[:500] if error else None
+
+    async def flush(self):
+        """把累积的增量写入数据库"""
+        async with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+
+            from app.database import async_session
+            from app.models.user import Token
+
+            tokens = Token.__table__
+            statement = update(tokens).where(tokens.c.id == bindparam("token_id")).values(
+                success_count=tokens.c.success_count + bindparam("success_delta", type_=Integer),
+                failure_count=tokens.c.failure_count + bindparam("failure_delta", type_=Integer),
+                last_used=func.coalesce(bindparam("new_last_used", type_=DateTime), tokens.c.last_used),
+                last_error=bindparam("new_last_error", type_=String),
+            )
+            rows = [{
+                "token_id": token_id,
+                "success_delta": delta.success,
+                "failure_delta": delta.failure,
+                "new_last_used": delta.last_used,
+                "new_last_error": delta.last_error,
+            } for token_id, delta in pending.items()]
+
+            try:
+                async with async_session() as db:
+                    await db.execute(statement, rows)
+                    await db.commit()
+            except Exception as e:
+                print(f"[Stats] 写入 token 统计失败: {e}", flush=True)
+                # 放回缓冲，下次再写（期间的新事件更新，保留其 last_error）
+                for token_id, delta in pending.items():
+                    newer = self._pending.get(token_id)
+                    if newer is None:
+                        self._pending[token_id] = delta
+                    else:
+                        newer.success += delta.success
+                        newer.failure += delta.failure
+                        newer.last_used = newer.last_used or delta.last_used
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=settings.stats_flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def start(self):
+        if self._runner is None:
+            self._runner = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._runner is not None:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
+        await self.flush()
+
+
+token_stats_buffer = TokenStatsBuffer()
@@ -0,0 +1,182 @@
+import asyncio
+from dataclasses import dataclass
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+
+from sqlalchemy import select
+
+from app.config import settings
+
+
+@dataclass
+class PooledToken:
+    """内存中的 token 快照（只包含选择和调用上游所需的字段）"""
+    id: int
+    user_id: int
+    token: str                  # 加密存储的 token
+    project_id: Optional[str]
+    is_public: bool
+    supports_claude: bool
+    supports_gemini: bool
+
+
+class _Bucket:
+    """支持 O(1) 添加、删除和随机选择的集合"""
+
+    def __init__(self):
+        self.items: List[int] = []
+        self.positions: Dict[int, int] = {}
+
+    def add(self, token_id: int):
+        if token_id not in self.positions:
+            self.positions[token_id] = len(self.items)
+            self.items.append(token_id)
+
+    def discard(self, token_id: int):
+        index = self.positions.pop(token_id, None)
+        if index is None:
+            return
+        last = self.items.pop()
+        if last != token_id:
+            self.items[index] = last
+            self.positions[last] = index
+
+    def __len__(self):
+        return len(self.items)
+
+
+def model_family(model: Optional[str]) -> str:
+    """模型类型：claude / gemini / any"""
+    name = (model or "").lower()
+    if "claude" in name:
+        return "claude"
+    if "gemini" in name:
+        return "gemini"
+    return "any"
+
+
+def _families(entry: PooledToken) -> Iterable[str]:
+    yield "any"
+    if entry.supports_claude:
+        yield "claude"
+    if entry.supports_gemini:
+        yield "gemini"
+
+
+class TokenIndex:
+    """进程内的可用 token 索引
+
+    只收录 is_active 的 token，按 公共池 / 所属用户 × 模型类型 分区，
+    选择 token 时不访问数据库。token 被增删改时由路由和 TokenPool 同步更新，
+    另外定期从数据库全量重建，以感知其他进程的修改。
+    """
+
+    def __init__(self):
+        self._entries: Dict[int, PooledToken] = {}
+        self._buckets: Dict[Tuple[Hashable, str], _Bucket] = {}
+        self._reload_task: Optional[asyncio.Task] = None
+
+    def _keys(self, entry: PooledToken) -> Iterable[Tuple[Hashable, str]]:
+        for family in _families(entry):
+            yield ("user", entry.user_id), family
+            if entry.is_public:
+                yield "public", family
+
+    def _add(self, entry: PooledToken):
+        self._entries[entry.id] = entry
+        for key in self._keys(entry):
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = _Bucket()
+            bucket.add(entry.id)
+
+    def remove(self, token_id: int):
+        """从索引中移除 token"""
+        entry = self._entries.pop(token_id, None)
+        if entry is None:
+            return
+        for key in self._keys(entry):
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(token_id)
+                if not bucket:
+                    del self._buckets[key]
+
+    def upsert(self, token):
+        """根据 Token 行更新索引（非活跃的 token 会被移除）"""
+        self.remove(token.id)
+        if token.is_active:
+            self._add(PooledToken(
+                id=token.id,
+                user_id=token.user_id,
+                token=token.token,
+                project_id=token.project_id,
+                is_public=bool(token.is_public),
+                supports_claude=bool(token.supports_claude),
+                supports_gemini=bool(token.supports_gemini),
+            ))
+
+    def update_ciphertext(self, token_id: int, ciphertext: str):
+        """刷新 access_token 后更新密文"""
+        entry = self._entries.get(token_id)
+        if entry is not None:
+            entry.token = ciphertext
+
+    def get(self, token_id: int) -> Optional[PooledToken]:
+        return self._entries.get(token_id)
+
+    def entries(self) -> List[PooledToken]:
+        return list(self._entries.values())
+
+    def candidates(self, scope: Hashable, model: Optional[str]) -> List[int]:
+        """返回分区内的 token id 列表（只读）"""
+        bucket = self._buckets.get((scope, model_family(model)))
+        return bucket.items if bucket else []
+
+    def has_public_tokens(self, user_id: int) -> bool:
+        """用户是否有捐赠到公共池的可用 token"""
+        bucket = self._buckets.get((("user", user_id), "any"))
+        return bool(bucket) and any(self._entries[i].is_public for i in bucket.items)
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def reload(self):
+        """从数据库全量重建索引"""
+        from app.database import async_session
+        from app.models.user import Token
+
+        async with async_session() as db:
+            result = await db.execute(select(Token).where(Token.is_active == True))
+            tokens = result.scalars().all()
+
+        self._entries = {}
+        self._buckets = {}
+        for token in tokens:
+            self.upsert(token)
+
+    async def _reload_loop(self):
+        while True:
+            await asyncio.sleep(settings.token_index_reload_interval)
+            try:
+                await self.reload()
+            except Exception as e:
+                print(f"[TokenIndex] 重建索引失败: {e}", flush=True)
+
+    async def start(self):
+        """加载索引并启动定期重建"""
+        await self.reload()
+        print(f"[TokenIndex] 已加载 {len(self)} 个可用 Token", flush=True)
+        if settings.token_index_reload_interval > 0 and self._reload_task is None:
+            self._reload_task = asyncio.create_task(self._reload_loop())
+
+    async def stop(self):
+        if self._reload_task is not None:
+            self._reload_task.cancel()
+            try:
+                await self._reload_task
+            except asyncio.CancelledError:
+                pass
+            self._reload_task = None
+
+
+token_index = TokenIndex()
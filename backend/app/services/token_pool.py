@@ -1,13 +1,64 @@
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func
-from typing import Optional, Tuple
+from sqlalchemy import case, select, func
+from collections import OrderedDict
+from typing import Optional, Set, Tuple
 import httpx
-import random
 import time
 
+from app.database import async_session
 from app.models.user import Token, User
 from app.config import settings
-from app.services.crypto import decrypt_token, encrypt_token
+from app.services.crypto import decrypt_token
+from app.services.token_index import PooledToken, token_index
+from app.services.scheduler import token_scheduler
+from app.services.cooldown import cooldown_queue
+from app.services.http_client import get_google_client
+from app.services.stats_writer import token_stats_buffer
+from app.services.auth_cache import auth_cache
+
+
+def is_auth_failure(status_code: Optional[int], error: str) -> bool:
+    """是否为认证错误：有状态码时只看状态码，没有状态码时才按错误文本判断
+
+    429 的错误正文里可能出现 "retryDelay": "4017s" 这样的内容，不能按子串匹配。
+    """
+    if status_code is not None:
+        return status_code in (401, 403)
+    return "401" in error or "403" in error or "unauthorized" in error.lower()
+
+
+class CredentialCache:
+    """解密并解析后的凭证缓存
+
+    按 token id 存放 (密文, 解析结果, 过期时间)，密文不一致时视为未命中，
+    因此刷新后的新密文不会读到旧结果。容量和 TTL 由配置控制（LRU 淘汰）。
+    """
+    
+    def __init__(self):
+        self._items: "OrderedDict[int, Tuple[str, dict, float]]" = OrderedDict()
+    
+    def get(self, token_id: int, ciphertext: str) -> Optional[dict]:
+        item = self._items.get(token_id)
+        if item is None:
+            return None
+        cached_ciphertext, data, expires = item
+        if cached_ciphertext != ciphertext or expires < time.monotonic():
+            del self._items[token_id]
+            return None
+        self._items.move_to_end(token_id)
+        return data
+    
+    def put(self, token_id: int, ciphertext: str, data: dict):
+        self._items[token_id] = (ciphertext, data, time.monotonic() + settings.credential_cache_ttl)
+        self._items.move_to_end(token_id)
+        while len(self._items) > settings.credential_cache_size:
+            self._items.popitem(last=False)
+    
+    def invalidate(self, token_id: int):
+        self._items.pop(token_id, None)
+
+
+credential_cache = CredentialCache()
 
 
 class TokenPool:
@@ -37,35 +88,45 @@ class TokenPool:
                 "expires_at": 0
             }
     
+    @staticmethod
+    def get_credentials(token) -> dict:
+        """获取 token 解密解析后的凭证（带缓存）"""
+        data = credential_cache.get(token.id, token.token)
+        if data is None:
+            data = TokenPool.parse_token_data(decrypt_token(token.token))
+            credential_cache.put(token.id, token.token, data)
+        return data
+    
     @staticmethod
     async def refresh_access_token(refresh_token: str) -> Optional[dict]:
         """使用 refresh_token 刷新 access_token"""
         try:
-            async with httpx.AsyncClient(timeout=30) as client:
-                response = await client.post(
-                    "https://oauth2.googleapis.com/token",
-                    data={
-                        "client_id": settings.google_client_id,
-                        "client_secret": settings.google_client_secret,
-                        "refresh_token": refresh_token,
-                        "grant_type": "refresh_token"
-                    }
-                )
-                if response.status_code == 200:
-                    data = response.json()
-                    return {
-                        "access_token": data.get("access_token"),
-                        "expires_in": data.get("expires_in", 3600)
-                    }
+            response = await get_google_client().post(
+                "https://oauth2.googleapis.com/token",
+                data={
+                    "client_id": settings.google_client_id,
+                    "client_secret": settings.google_client_secret,
+                    "refresh_token": refresh_token,
+                    "grant_type": "refresh_token"
+                },
+                timeout=30
+            )
+            if response.status_code == 200:
+                data = response.json()
+                return {
+                    "access_token": data.get("access_token"),
+                    "expires_in": data.get("expires_in", 3600)
+                }
         except Exception as e:
             print(f"[TokenPool] 刷新 token 失败: {e}", flush=True)
         return None
     
     @staticmethod
-    async def get_access_token(token: Token, db: AsyncSession) -> Optional[str]:
-        """获取有效的 access_token，必要时自动刷新"""
-        decrypted = decrypt_token(token.token)
-        token_data = TokenPool.parse_token_data(decrypted)
+    async def get_access_token(token: PooledToken) -> Optional[str]:
+        """获取有效的 access_token，必要时刷新（通常已由后台提前刷新）"""
+        from app.services.refresh_scheduler import refresh_scheduler
+        
+        token_data = TokenPool.get_credentials(token)
         
         access_token = token_data["access_token"]
         refresh_token = token_data["refresh_token"]
@@ -76,98 +137,63 @@ class TokenPool:
         if expires_at > 0 and now < expires_at - 300:
             return access_token
         
-        # 需要刷新
+        # 需要刷新：与后台刷新和其他并发请求共享同一次刷新
         if refresh_token:
-            print(f"[TokenPool] Token #{token.id} 需要刷新...", flush=True)
-            new_token_data = await TokenPool.refresh_access_token(refresh_token)
-            if new_token_data:
-                new_access = new_token_data["access_token"]
-                new_expires_at = now + new_token_data["expires_in"]
-                
-                # 更新存储
-                new_stored = f"{new_access}|||{refresh_token}|||{new_expires_at}"
-                token.token = encrypt_token(new_stored)
-                await db.commit()
-                
-                print(f"[TokenPool] Token #{token.id} 刷新成功", flush=True)
-                return new_access
-            else:
-                print(f"[TokenPool] Token #{token.id} 刷新失败", flush=True)
-                return None
+            return await refresh_scheduler.refresh(token.id)
         
         # 没有 refresh_token，直接返回 access_token
         return access_token
     
     @staticmethod
-    async def get_token_for_request(
-        db: AsyncSession,
+    def get_token_for_request(
         user: User,
-        model: str = None
-    ) -> Optional[Tuple[int, Token]]:
-        """获取一个可用的 token 对象"""
-        
-        # 判断模型类型
-        is_claude = model and "claude" in model.lower()
-        is_gemini = model and "gemini" in model.lower()
-        
-        # 构建查询条件
-        query = select(Token).where(
-            Token.is_active == True,
-            Token.is_public == True
-        )
-        
-        # 按模型类型筛选
-        if is_claude:
-            query = query.where(Token.supports_claude == True)
-        elif is_gemini:
-            query = query.where(Token.supports_gemini == True)
-        
-        result = await db.execute(query)
-        tokens = result.scalars().all()
+        model: str = None,
+        exclude: Optional[Set[int]] = None
+    ) -> Optional[Tuple[int, PooledToken]]:
+        """从内存索引中获取一个可用的 token（exclude 中的 token 不参与选择）"""
+        # 跳过已尝试过的和正在冷却的 token
+        unavailable = cooldown_queue.unavailable(model, exclude)
+        token_id = token_scheduler.select(token_index.candidates("public", model), unavailable)
         
-        if not tokens:
+        if token_id is None:
             # 如果公共池没有，尝试用户自己的 token
-            user_query = select(Token).where(
-                Token.user_id == user.id,
-                Token.is_active == True
-            )
-            if is_claude:
-                user_query = user_query.where(Token.supports_claude == True)
-            elif is_gemini:
-                user_query = user_query.where(Token.supports_gemini == True)
-            
-            result = await db.execute(user_query)
-            tokens = result.scalars().all()
+            token_id = token_scheduler.select(token_index.candidates(("user", user.id), model), unavailable)
         
-        if not tokens:
+        if token_id is None:
             return None
         
-        # 随机选择一个 token
-        token = random.choice(tokens)
-        return (token.id, token)
+        return (token_id, token_index.get(token_id))
     
     @staticmethod
-    async def report_success(db: AsyncSession, token_id: int):
-        """报告成功使用"""
-        result = await db.execute(select(Token).where(Token.id == token_id))
-        token = result.scalar_one_or_none()
-        if token:
-            token.success_count += 1
-            token.last_used = func.now()
-            token.last_error = None
-            await db.commit()
+    def report_success(token_id: int):
+        """报告成功使用（计数写回由后台批量完成）"""
+        token_stats_buffer.record_success(token_id)
     
     @staticmethod
-    async def report_failure(db: AsyncSession, token_id: int, error: str):
-        """报告使用失败"""
-        result = await db.execute(select(Token).where(Token.id == token_id))
-        token = result.scalar_one_or_none()
-        if token:
-            token.failure_count += 1
-            token.last_error = error[:500] if error else None
+    async def report_failure(
+        token_id: int,
+        error: str,
+        model: str = None,
+        status_code: int = None,
+        retry_after: float = None
+    ):
+        """报告使用失败；上游限流（429）时让 token 在该模型类型上冷却，认证错误时立即禁用"""
+        if status_code == 429:
+            cooldown_queue.park(token_id, model, retry_after, error)
+        
+        token_stats_buffer.record_failure(token_id, error)
+        
+        # 如果是认证错误，禁用 token
+        if is_auth_failure(status_code, error):
+            token_index.remove(token_id)
+            token_scheduler.forget(token_id)
+            credential_cache.invalidate(token_id)
             
-            # 如果是认证错误，禁用 token
-            if "401" in error or "403" in error or "unauthorized" in error.lower():
+            async with async_session() as db:
+                result = await db.execute(select(Token).where(Token.id == token_id))
+                token = result.scalar_one_or_none()
+                if not token:
+                    return
                 token.is_active = False
                 
                 # 扣除用户额度
@@ -179,8 +205,9 @@ class TokenPool:
                         if user.daily_quota - settings.default_daily_quota >= deduct:
                             user.daily_quota = max(settings.default_daily_quota, user.daily_quota - deduct)
                             print(f"[Token失效] 用户 {user.username} 扣除 {deduct} 额度", flush=True)
-            
-            await db.commit()
+                
+                await db.commit()
+            auth_cache.invalidate_user(token.user_id)
     
     @staticmethod
     async def verify_token(token: str) -> dict:
@@ -213,32 +240,17 @@ class TokenPool:
     
     @staticmethod
     async def get_pool_stats(db: AsyncSession) -> dict:
-        """获取 token 池统计"""
-        # 总数
-        total_result = await db.execute(select(func.count(Token.id)).where(Token.is_public == True))
-        total = total_result.scalar() or 0
-        
-        # 有效数
-        valid_result = await db.execute(
-            select(func.count(Token.id)).where(Token.is_public == True, Token.is_active == True)
-        )
-        valid = valid_result.scalar() or 0
-        
-        # Claude 可用
-        claude_result = await db.execute(
-            select(func.count(Token.id)).where(
-                Token.is_public == True, Token.is_active == True, Token.supports_claude == True
-            )
-        )
-        claude = claude_result.scalar() or 0
-        
-        # Gemini 可用
-        gemini_result = await db.execute(
-            select(func.count(Token.id)).where(
-                Token.is_public == True, Token.is_active == True, Token.supports_gemini == True
-            )
+        """获取 token 池统计（一次聚合查询，走公共池的部分索引）"""
+        active = Token.is_active == True
+        result = await db.execute(
+            select(
+                func.count(Token.id),
+                func.sum(case((active, 1), else_=0)),
+                func.sum(case((active & (Token.supports_claude == True), 1), else_=0)),
+                func.sum(case((active & (Token.supports_gemini == True), 1), else_=0)),
+            ).where(Token.is_public == True)
         )
-        gemini = gemini_result.scalar() or 0
+        total, valid, claude, gemini = (value or 0 for value in result.one())
         
         return {
             "total": total,
@@ -0,0 +1,189 @@
+import asyncio
+from collections import deque
+from datetime import datetime
+from typing import Deque, List, Optional
+
+from sqlalchemy import insert
+from sqlalchemy.exc import DataError, IntegrityError
+
+from app.config import settings
+
+
+# 对冲请求中额外一次上游调用的记录以此开头，不计入用户配额
+HEDGE_ERROR_PREFIX = "hedge "
+
+
+class UsageBacklogError(Exception):
+    """写入积压，等待超时"""
+
+
+class UsageRecord:
+    """一次请求的使用记录，请求结束时由 finish() 提交给写入队列"""
+    __slots__ = ("user_id", "token_id", "model", "success", "error_message", "created_at", "finished")
+
+    def __init__(self, user_id: int, token_id: Optional[int], model: Optional[str]):
+        self.user_id = user_id
+        self.token_id = token_id
+        self.model = model
+        self.success = True
+        self.error_message: Optional[str] = None
+        self.created_at = datetime.utcnow()
+        self.finished = False
+
+    def row(self) -> dict:
+        return {
+            "user_id": self.user_id,
+            "token_id": self.token_id,
+            "model": self.model,
+            "success": self.success,
+            "error_message": self.error_message,
+            "created_at": self.created_at,
+        }
+
+
+class UsageLogWriter:
+    """UsageLog 的异步批量写入
+
+    请求开始时 begin() 登记一条记录，结束时 finish() 放入队列，
+    后台任务每 usage_flush_interval 秒（或队列达到 usage_batch_size 条时）
+    批量 INSERT。队列积压超过 usage_queue_size 条时 begin() 会等待，
+    超过 usage_queue_timeout 秒抛出 UsageBacklogError。一批连续写入失败
+    usage_max_batch_failures 次后改为逐条写入，违反约束的记录打印日志后丢弃，
+    不会一直挡住后面的记录。关闭时把剩余的记录全部写完。
+    """
+
+    def __init__(self):
+        self._queue: Deque[UsageRecord] = deque()
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Event()
+        self._space.set()
+        self._runner: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        self._failures = 0
+        self.written = 0
+        self.dropped = 0
+
+    async def begin(self, user_id: int, model: Optional[str], token_id: Optional[int] = None) -> UsageRecord:
+        """登记一次请求；写入跟不上时在这里等待（背压），超时抛出 UsageBacklogError"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + settings.usage_queue_timeout
+        while len(self._queue) >= settings.usage_queue_size:
+            self._space.clear()
+            self._wakeup.set()
+            try:
+                await asyncio.wait_for(self._space.wait(), timeout=max(0.0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                raise UsageBacklogError("使用日志写入积压，请稍后重试")
+        return UsageRecord(user_id, token_id, model)
+
+    def finish(
+        self,
+        record: UsageRecord,
+        token_id: Optional[int] = None,
+        success: bool = True,
+        error: Optional[str] = None
+    ):
+        """请求结束，记录实际使用的 token 和结果（重复调用只生效一次）"""
+        if record.finished:
+            return
+        record.finished = True
+        if token_id is not None:
+            record.token_id = token_id
+        record.success = success
+        record.error_message = error[:500] if error else None
+        self._queue.append(record)
+        if len(self._queue) >= settings.usage_batch_size:
+            self._wakeup.set()
+
+    def record_hedge_attempt(self, user_id: int, model: Optional[str], token_id: int, error: str):
+        """记录对冲请求中没有被采用的那次上游调用（被取消或先失败），不等待队列空间"""
+        record = UsageRecord(user_id, token_id, model)
+        self.finish(record, success=False, error=HEDGE_ERROR_PREFIX + error)
+
+    async def flush(self):
+        """把队列中的记录写入数据库"""
+        from app.database import async_session
+        from app.models.user import UsageLog
+
+        async with self._lock:
+            while self._queue:
+                batch = [self._queue.popleft() for _ in range(min(len(self._queue), settings.usage_batch_size))]
+                try:
+                    async with async_session() as db:
+                        await db.execute(insert(UsageLog.__table__), [record.row() for record in batch])
+                        await db.commit()
+                except Exception as e:
+                    self._failures += 1
+                    print(f"[Usage] 写入使用日志失败（连续第 {self._failures} 次）: {e}", flush=True)
+                    processed = 0
+                    if self._failures >= settings.usage_max_batch_failures:
+                        processed = await self._flush_one_by_one(batch)
+                    # 剩下的放回队首，下次再写
+                    self._queue.extendleft(reversed(batch[processed:]))
+                    if processed:
+                        self._space.set()
+                    return
+                self._failures = 0
+                self.written += len(batch)
+                self._space.set()
+
+    async def _flush_one_by_one(self, batch: List[UsageRecord]) -> int:
+        """逐条写入，违反约束或数据无效的记录打印日志后丢弃（token 已删除的记录去掉 token_id 后保留）；
+        遇到其他错误（例如数据库不可用）时停止
+
+        返回已处理（写入或丢弃）的条数。
+        """
+        for index, record in enumerate(batch):
+            try:
+                try:
+                    await self._insert_one(record)
+                except IntegrityError:
+                    if record.token_id is None:
+                        raise
+                    # token 在请求期间被删除：保留日志，去掉 token_id
+                    print(f"[Usage] token {record.token_id} 已不存在，使用日志不再关联 token", flush=True)
+                    record.token_id = None
+                    await self._insert_one(record)
+                self.written += 1
+            except (IntegrityError, DataError) as e:
+                self.dropped += 1
+                print(f"[Usage] 丢弃无法写入的使用日志 {record.row()}: {e}", flush=True)
+            except Exception:
+                return index
+        self._failures = 0
+        return len(batch)
+
+    @staticmethod
+    async def _insert_one(record: UsageRecord):
+        from app.database import async_session
+        from app.models.user import UsageLog
+
+        async with async_session() as db:
+            await db.execute(insert(UsageLog.__table__), [record.row()])
+            await db.commit()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=settings.usage_flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def start(self):
+        if self._runner is None:
+            self._runner = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._runner is not None:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
+        await self.flush()
+
+
+usage_writer = UsageLogWriter()
@@ -0,0 +1,86 @@
+"""登录风暴下的流式延迟基准测试
+
+模拟一个每 10ms 输出一个 SSE 块的流，同时并发发起登录（argon2 校验），
+对比在事件循环中直接计算与放到密码线程池中计算时，流的输出间隔抖动。
+
+用法（在 backend 目录下）:
+    python -m benchmarks.login_storm [--logins 64] [--concurrency 16]
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from app.config import settings
+from app.services.auth import get_password_hash, verify_password, verify_password_async
+
+TICK = 0.01
+
+
+async def stream_ticker(stop: asyncio.Event, delays: list):
+    """模拟 SSE 流：记录每个块相对预期时间的延迟"""
+    expected = time.perf_counter() + TICK
+    while not stop.is_set():
+        await asyncio.sleep(max(0.0, expected - time.perf_counter()))
+        now = time.perf_counter()
+        delays.append(now - expected)
+        expected = now + TICK
+
+
+async def login_inline(password: str, hashed: str):
+    # 旧的做法：在协程中同步计算
+    return verify_password(password, hashed)
+
+
+async def login_pooled(password: str, hashed: str):
+    return await verify_password_async(password, hashed)
+
+
+async def run(mode, logins: int, concurrency: int, hashed: str) -> dict:
+    stop = asyncio.Event()
+    delays: list = []
+    ticker = asyncio.create_task(stream_ticker(stop, delays))
+    await asyncio.sleep(0.1)
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            await mode("benchmark-password", hashed)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(logins)])
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    await ticker
+    delays.sort()
+    return {
+        "logins_per_sec": logins / elapsed,
+        "p50_ms": statistics.median(delays) * 1000,
+        "p99_ms": delays[int(len(delays) * 0.99) - 1] * 1000,
+        "max_ms": delays[-1] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logins", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=16)
+    args = parser.parse_args()
+
+    settings.password_hash_max_pending = max(settings.password_hash_max_pending, args.concurrency)
+    hashed = get_password_hash("benchmark-password")
+
+    print(f"argon2: t={settings.argon2_time_cost} m={settings.argon2_memory_cost}KiB "
+          f"p={settings.argon2_parallelism}, 线程池 {settings.password_hash_workers}, "
+          f"{args.logins} 次登录 / 并发 {args.concurrency}")
+    print(f"{'模式':<10}{'登录/秒':>10}{'流 p50(ms)':>14}{'流 p99(ms)':>14}{'流 max(ms)':>14}")
+    for name, mode in (("事件循环内", login_inline), ("线程池", login_pooled)):
+        result = asyncio.run(run(mode, args.logins, args.concurrency, hashed))
+        print(f"{name:<10}{result['logins_per_sec']:>10.1f}{result['p50_ms']:>14.2f}"
+              f"{result['p99_ms']:>14.2f}{result['max_ms']:>14.2f}")
+
+
+if __name__ == "__main__":
+    main()
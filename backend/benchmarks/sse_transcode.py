@@ -0,0 +1,124 @@
+"""SSE 转码基准测试
+
+对比旧的逐行 str 解码 + json.loads + dict 构造 + json.dumps 流程，
+与新的字节级切分 + 预序列化信封流程，输出单核 chunks/sec。
+
+用法（在 backend 目录下）:
+    python -m benchmarks.sse_transcode [--chunks 20000] [--rounds 5]
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from app.services.sse import (
+    ChatChunkEncoder, JSON_BACKEND, iter_sse_data, extract_gemini_delta, json_loads
+)
+
+
+def build_upstream_payload(chunks: int) -> list:
+    """构造模拟的 Gemini SSE 字节流（按网络包大小切分）"""
+    body = bytearray()
+    for i in range(chunks):
+        data = {
+            "response": {
+                "candidates": [{
+                    "content": {"role": "model", "parts": [{"text": f"token {i} 你好，世界。"}]}
+                }],
+                "usageMetadata": {"promptTokenCount": 12, "candidatesTokenCount": i},
+                "modelVersion": "gemini-2.5-flash"
+            }
+        }
+        body += b"data: " + json.dumps(data).encode() + b"\r\n\r\n"
+
+    packet = 1400
+    return [bytes(body[i:i + packet]) for i in range(0, len(body), packet)]
+
+
+async def _aiter(packets: list):
+    for packet in packets:
+        yield packet
+
+
+async def _aiter_lines(packets: list):
+    """模拟 httpx.Response.aiter_lines 的 str 解码和行切分"""
+    buffer = ""
+    for packet in packets:
+        buffer += packet.decode()
+        lines = buffer.split("\n")
+        buffer = lines.pop()
+        for line in lines:
+            yield line.rstrip("\r")
+
+
+async def legacy_pipeline(packets: list, model: str) -> int:
+    """旧流程：aiter_lines -> json.loads -> dict -> json.dumps"""
+    count = 0
+    async for line in _aiter_lines(packets):
+        if line.startswith("data: "):
+            try:
+                data = json.loads(line[6:])
+                response_data = data.get("response", data)
+                candidates = response_data.get("candidates", [])
+                if not candidates:
+                    continue
+                parts = candidates[0].get("content", {}).get("parts", [])
+                text = "".join(p.get("text", "") for p in parts)
+                if not text:
+                    continue
+                chunk = {
+                    "id": f"chatcmpl-{id(data)}",
+                    "object": "chat.completion.chunk",
+                    "created": 0,
+                    "model": model,
+                    "choices": [{"index": 0, "delta": {"content": text}, "finish_reason": None}]
+                }
+                out = f"data: {json.dumps(chunk)}\n\n"
+                count += len(out) > 0
+            except:
+                pass
+    return count
+
+
+async def fast_pipeline(packets: list, model: str) -> int:
+    """新流程：字节级切分 -> 快速 JSON 解析 -> 预序列化信封拼接"""
+    count = 0
+    encoder = ChatChunkEncoder(model)
+    async for raw in iter_sse_data(_aiter(packets)):
+        text, _ = extract_gemini_delta(json_loads(raw))
+        if text:
+            out = encoder.delta(text)
+            count += len(out) > 0
+    return count
+
+
+def measure(pipeline, packets: list, chunks: int, rounds: int) -> float:
+    """返回最好一轮的 chunks/sec"""
+    best = 0.0
+    for _ in range(rounds):
+        start = time.process_time()
+        produced = asyncio.run(pipeline(packets, "gemini-2.5-flash"))
+        elapsed = time.process_time() - start
+        assert produced == chunks, f"{pipeline.__name__} 产出 {produced} 块，期望 {chunks}"
+        best = max(best, chunks / elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SSE 转码基准测试")
+    parser.add_argument("--chunks", type=int, default=20000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    packets = build_upstream_payload(args.chunks)
+    legacy = measure(legacy_pipeline, packets, args.chunks, args.rounds)
+    fast = measure(fast_pipeline, packets, args.chunks, args.rounds)
+
+    print(f"JSON 后端: {JSON_BACKEND}")
+    print(f"旧流程: {legacy:>12,.0f} chunks/sec/core")
+    print(f"新流程: {fast:>12,.0f} chunks/sec/core")
+    print(f"提升:   {fast / legacy:>12.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,10 +5,19 @@ from fastapi.responses import FileResponse
 from contextlib import asynccontextmanager
 import os
 
-from app.database import init_db
+from app.database import init_db, engine
 from app.config import settings, load_config_from_db
 from app.models.user import User
-from app.services.auth import get_password_hash
+from app.services.auth import get_password_hash_async
+from app.services.http_client import init_http_clients, close_http_clients
+from app.services.token_index import token_index
+from app.services.refresh_scheduler import refresh_scheduler
+from app.services.stats_writer import token_stats_buffer
+from app.services.usage_writer import usage_writer
+from app.services.rate_limit import rate_limiter
+from app.services.api_keys import revocation_watcher
+from app.services.reencrypt import reencrypt_job
+from app.services.public_stats import public_stats
 
 
 @asynccontextmanager
@@ -18,9 +27,27 @@ async def lifespan(app: FastAPI):
     await init_db()
     await load_config_from_db()
     await create_admin_user()
+    await init_http_clients()
+    await token_index.start()
+    await refresh_scheduler.start()
+    await token_stats_buffer.start()
+    await usage_writer.start()
+    await rate_limiter.start()
+    await revocation_watcher.start()
+    await public_stats.start()
     print(f"✅ 服务启动完成 - http://{settings.host}:{settings.port}", flush=True)
     yield
     # 关闭时
+    await public_stats.stop()
+    await reencrypt_job.stop()
+    await revocation_watcher.stop()
+    await rate_limiter.stop()
+    await refresh_scheduler.stop()
+    await token_stats_buffer.stop()
+    await usage_writer.stop()
+    await token_index.stop()
+    await close_http_clients()
+    await engine.dispose()
     print("👋 服务关闭", flush=True)
 
 
@@ -41,11 +68,12 @@ app.add_middleware(
 )
 
 # 路由
-from app.routers import auth, proxy, public, oauth
+from app.routers import auth, proxy, public, oauth, admin
 app.include_router(auth.router)
 app.include_router(proxy.router)
 app.include_router(public.router)
 app.include_router(oauth.router)
+app.include_router(admin.router)
 
 # 静态文件
 static_dir = os.path.join(os.path.dirname(__file__), "static")
@@ -74,7 +102,7 @@ async def create_admin_user():
         if not result.scalar_one_or_none():
             admin = User(
                 username=settings.admin_username,
-                password_hash=get_password_hash(settings.admin_password),
+                password_hash=await get_password_hash_async(settings.admin_password),
                 is_admin=True,
                 daily_quota=999999
             )
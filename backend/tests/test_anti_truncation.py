@@ -0,0 +1,125 @@
+import asyncio
+import json
+
+import pytest
+
+from app.config import settings
+from app.services.gemini_client import ANTI_TRUNCATION_MARKER, CompletionMarkerFilter, GeminiClient
+
+MARKER = ANTI_TRUNCATION_MARKER
+
+
+def run_filter(chunks):
+    markers = CompletionMarkerFilter()
+    emitted = [markers.feed(chunk) for chunk in chunks]
+    rest, completed = markers.finish()
+    return "".join(emitted) + rest, completed
+
+
+def split_every(text: str, size: int):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def test_marker_is_a_short_literal():
+    # 分割测试依赖标记本身不含空白
+    assert MARKER == "[done]"
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 7, 100])
+def test_marker_split_across_chunks(size):
+    assert run_filter(split_every(f"Hello world\n{MARKER}", size)) == ("Hello world", True)
+
+
+@pytest.mark.parametrize("text", [
+    f"answer{MARKER}",
+    f"answer {MARKER}",
+    f"answer\n\n{MARKER}\n",
+    f"answer {MARKER}   ",
+])
+def test_marker_at_end_with_surrounding_whitespace(text):
+    for size in (1, 4, len(text)):
+        assert run_filter(split_every(text, size)) == ("answer", True)
+
+
+@pytest.mark.parametrize("size", [1, 3, 100])
+def test_marker_in_model_output_is_kept(size):
+    text = f"Use {MARKER} to mark finished tasks, then continue."
+    assert run_filter(split_every(text, size)) == (text, False)
+
+
+def test_only_trailing_marker_completes():
+    assert run_filter([f"{MARKER} then {MARKER}"]) == (f"{MARKER} then", True)
+
+
+@pytest.mark.parametrize("chunks", [["partial [do"], ["partial [", "do"], ["[done"], ["[do", "ne", " ]"]])
+def test_incomplete_marker_is_emitted_as_text(chunks):
+    assert run_filter(chunks) == ("".join(chunks), False)
+
+
+def test_text_is_released_as_soon_as_it_cannot_be_the_marker():
+    markers = CompletionMarkerFilter()
+    assert markers.feed("Hello [d") == "Hello"
+    assert markers.feed("og]") == " [dog]"
+    assert markers.feed("\n\n") == ""
+    assert markers.feed("more") == "\n\nmore"
+    assert markers.finish() == ("", False)
+
+
+def _event(text: str, finish_reason: str = None) -> dict:
+    candidate = {"content": {"parts": [{"text": text}]}}
+    if finish_reason:
+        candidate["finishReason"] = finish_reason
+    return {"response": {"candidates": [candidate]}}
+
+
+def _collect_stream(monkeypatch, rounds):
+    """用预设的多轮上游事件驱动抗截断流，返回 (输出文本, finish_reason, 发出的请求)"""
+    payloads = []
+
+    async def fake_stream_events(self, payload):
+        payloads.append(payload)
+        for event in rounds[len(payloads) - 1]:
+            yield event
+
+    monkeypatch.setattr(GeminiClient, "_stream_events", fake_stream_events)
+
+    async def collect():
+        client = GeminiClient("token", "project")
+        return [chunk async for chunk in client.chat_completions_stream(
+            "流式抗截断/gemini-2.5-flash", [{"role": "user", "content": "hi"}]
+        )]
+
+    text, finish_reason = "", None
+    for chunk in asyncio.run(collect()):
+        if chunk.startswith(b"data: {"):
+            choice = json.loads(chunk[6:])["choices"][0]
+            text += choice["delta"].get("content", "")
+            finish_reason = choice["finish_reason"] or finish_reason
+    return text, finish_reason, payloads
+
+
+def test_stream_strips_split_marker_without_continuation(monkeypatch):
+    rounds = [[_event("Hello wor"), _event("ld [do"), _event("ne]", "STOP")]]
+    text, finish_reason, payloads = _collect_stream(monkeypatch, rounds)
+    assert (text, finish_reason, len(payloads)) == ("Hello world", "stop", 1)
+
+
+def test_stream_continues_when_marker_is_missing(monkeypatch):
+    monkeypatch.setattr(settings, "anti_truncation_max_rounds", 2)
+    rounds = [
+        [_event(f"Mark with {MARKER} when"), _event(" done", "MAX_TOKENS")],
+        [_event(" and stop."), _event(f"\n{MARKER}", "STOP")],
+    ]
+    text, finish_reason, payloads = _collect_stream(monkeypatch, rounds)
+    assert text == f"Mark with {MARKER} when done and stop."
+    assert finish_reason == "stop"
+    # 续写请求带上了第一轮的完整输出（包括正文中的标记）
+    contents = payloads[1]["request"]["contents"]
+    assert contents[1]["parts"][0]["text"] == f"Mark with {MARKER} when done"
+
+
+def test_stream_reports_length_after_max_rounds(monkeypatch):
+    monkeypatch.setattr(settings, "anti_truncation_max_rounds", 1)
+    rounds = [[_event("a", "MAX_TOKENS")], [_event("b", "MAX_TOKENS")]]
+    text, finish_reason, payloads = _collect_stream(monkeypatch, rounds)
+    assert (text, finish_reason, len(payloads)) == ("ab", "length", 2)
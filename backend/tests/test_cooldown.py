@@ -0,0 +1,93 @@
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import httpx
+import pytest
+
+from app.services.cooldown import CooldownQueue, parse_retry_after
+
+
+def headers(**values) -> httpx.Headers:
+    return httpx.Headers({key.replace("_", "-"): value for key, value in values.items()})
+
+
+def http_date(seconds_from_now: float) -> str:
+    return format_datetime(datetime.now(timezone.utc) + timedelta(seconds=seconds_from_now), usegmt=True)
+
+
+def google_error(details: str) -> str:
+    return '{"error": {"code": 429, "status": "RESOURCE_EXHAUSTED", "details": [' + details + "]}}"
+
+
+def test_retry_after_seconds():
+    assert parse_retry_after(headers(Retry_After="7")) == 7.0
+    assert parse_retry_after(headers(Retry_After=" 120 ")) == 120.0
+
+
+def test_retry_after_http_date():
+    assert parse_retry_after(headers(Retry_After=http_date(30))) == pytest.approx(30, abs=2)
+
+
+def test_retry_after_http_date_in_the_past_is_zero():
+    assert parse_retry_after(headers(Retry_After=http_date(-60))) == 0.0
+
+
+def test_header_wins_over_body():
+    body = google_error('{"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": "99s"}')
+    assert parse_retry_after(headers(Retry_After="3"), body) == 3.0
+
+
+@pytest.mark.parametrize("delay, expected", [
+    ("34s", 34.0),
+    ("1.5s", 1.5),
+    ("300ms", 0.3),
+    ("2m", 120.0),
+    ("1h2m3.5s", 3723.5),
+])
+def test_body_retry_delay(delay, expected):
+    body = google_error('{"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": "' + delay + '"}')
+    assert parse_retry_after(None, body) == pytest.approx(expected)
+
+
+def test_body_quota_reset_delay():
+    body = google_error(
+        '{"@type": "type.googleapis.com/google.rpc.ErrorInfo",'
+        ' "metadata": {"quotaResetDelay": "12.25s", "model": "gemini-2.5-pro"}}'
+    )
+    assert parse_retry_after(headers(), body) == pytest.approx(12.25)
+
+
+def test_body_quota_reset_timestamp():
+    reset = (datetime.now(timezone.utc) + timedelta(minutes=5)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    body = google_error('{"metadata": {"quotaResetTimeStamp": "' + reset + '"}}')
+    assert parse_retry_after(None, body) == pytest.approx(300, abs=2)
+
+
+def test_invalid_header_falls_back_to_body():
+    body = '{"retryDelay": "5s"}'
+    assert parse_retry_after(headers(Retry_After="soon"), body) == 5.0
+
+
+@pytest.mark.parametrize("body", ["", "quota exceeded", '{"retryDelay": "later"}', '{"quotaResetTimeStamp": "bad"}'])
+def test_nothing_to_parse(body):
+    assert parse_retry_after(headers(), body) is None
+
+
+def test_cooldown_is_shared_by_model_family():
+    queue = CooldownQueue()
+    queue.park(1, "gemini-2.5-pro", 30)
+    assert queue.is_parked(1, "gemini-2.5-flash")
+    assert queue.is_parked(1, "假流式/gemini-2.5-pro-preview-06-05")
+    assert 1 in queue.unavailable("流式抗截断/gemini-3-pro-preview")
+    assert not queue.is_parked(1, "claude-sonnet-4.5")
+    assert not queue.is_parked(2, "gemini-2.5-pro")
+
+    queue.release(1, "gemini-2.5-flash")
+    assert not queue.is_parked(1, "gemini-2.5-pro")
+
+
+def test_cooldown_keeps_the_later_deadline():
+    queue = CooldownQueue()
+    queue.park(1, "gemini-2.5-pro", 300)
+    queue.park(1, "gemini-2.5-flash", 5)
+    assert queue.snapshot()[0]["remaining"] > 200
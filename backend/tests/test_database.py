@@ -0,0 +1,179 @@
+"""数据库引擎与会话测试
+
+默认在临时 SQLite 文件上运行；设置 TEST_POSTGRES_URL（postgresql+asyncpg://...）后
+同样的用例也在 PostgreSQL 上运行。PostgreSQL 库会被清空重建，请使用专门的测试库。
+"""
+import asyncio
+import os
+
+import pytest
+from sqlalchemy import delete, event, func, select, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from app import database
+from app.config import settings
+from app.database import Base, build_engine, init_db
+from app.migrations import MIGRATIONS, schema_version
+from app.models.user import Token, UsageLog, User
+from app.services.quota import QuotaTracker
+from app.services.usage_writer import UsageLogWriter
+
+POSTGRES_URL = os.environ.get("TEST_POSTGRES_URL")
+
+
+@pytest.fixture(params=["sqlite", "postgresql"])
+def database_url(request, tmp_path):
+    if request.param == "sqlite":
+        return make_url(f"sqlite+aiosqlite:///{tmp_path / 'test.db'}")
+    if not POSTGRES_URL:
+        pytest.skip("未设置 TEST_POSTGRES_URL")
+    return make_url(POSTGRES_URL)
+
+
+def _enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+def run(url, scenario, monkeypatch=None):
+    """为 url 建引擎、初始化表结构后执行 scenario(engine, sessions)
+
+    SQLite 上打开外键检查，与 PostgreSQL 的行为一致；传入 monkeypatch 时
+    让 app.database 的会话和 upsert 指向测试库。
+    """
+    async def main():
+        engine = build_engine(url)
+        if engine.dialect.name == "sqlite":
+            event.listen(engine.sync_engine, "connect", _enable_sqlite_foreign_keys)
+        else:
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.drop_all)
+                await conn.run_sync(schema_version.drop, checkfirst=True)
+        sessions = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+        if monkeypatch is not None:
+            monkeypatch.setattr(database, "async_session", sessions)
+            dialect = sqlite if engine.dialect.name == "sqlite" else postgresql
+            monkeypatch.setattr(database, "upsert_insert", dialect.insert)
+        try:
+            await init_db(engine)
+            await scenario(engine, sessions)
+        finally:
+            await engine.dispose()
+
+    asyncio.run(main())
+
+
+async def add_user(sessions, username="alice") -> int:
+    async with sessions() as db:
+        user = User(username=username, password_hash="x")
+        db.add(user)
+        await db.commit()
+        return user.id
+
+
+async def add_token(sessions, user_id: int) -> int:
+    async with sessions() as db:
+        token = Token(user_id=user_id, token="encrypted")
+        db.add(token)
+        await db.commit()
+        return token.id
+
+
+def test_sessions_use_separate_connections(database_url):
+    async def scenario(engine, sessions):
+        async with sessions() as first, sessions() as second:
+            first.add(User(username="pending", password_hash="x"))
+            await first.flush()
+            # 共享一个连接时，这里会读到 first 还没提交的写入，first 回滚也会撤销 second 的写入
+            assert await second.scalar(select(func.count(User.id))) == 0
+            await first.rollback()
+            second.add(User(username="committed", password_hash="x"))
+            await second.commit()
+
+        async with sessions() as db:
+            names = (await db.scalars(select(User.username))).all()
+        assert names == ["committed"]
+
+    run(database_url, scenario)
+
+
+def test_migrations_are_recorded_once(database_url):
+    async def scenario(engine, sessions):
+        await init_db(engine)
+        async with engine.connect() as conn:
+            versions = (await conn.execute(select(schema_version.c.version))).scalars().all()
+        assert sorted(versions) == [version for version, _, _ in MIGRATIONS]
+
+    run(database_url, scenario)
+
+
+async def delete_token_with_logs(sessions):
+    user_id = await add_user(sessions)
+    token_id = await add_token(sessions, user_id)
+    async with sessions() as db:
+        db.add(UsageLog(user_id=user_id, token_id=token_id, model="gemini-2.5-pro"))
+        await db.commit()
+
+    async with sessions() as db:
+        await db.execute(delete(Token).where(Token.id == token_id))
+        await db.commit()
+
+    async with sessions() as db:
+        logs = (await db.execute(select(UsageLog.user_id, UsageLog.token_id))).all()
+    assert logs == [(user_id, None)]
+
+
+def test_deleting_token_keeps_usage_logs(database_url):
+    run(database_url, lambda engine, sessions: delete_token_with_logs(sessions))
+
+
+def test_migration_replaces_old_usage_log_foreign_key(database_url):
+    if database_url.get_backend_name() != "postgresql":
+        pytest.skip("SQLite 不修改已有的外键")
+
+    async def scenario(engine, sessions):
+        # 模拟旧库：外键没有 ON DELETE SET NULL，迁移 #2 还没执行
+        async with engine.begin() as conn:
+            await conn.execute(text("ALTER TABLE usage_logs DROP CONSTRAINT usage_logs_token_id_fkey"))
+            await conn.execute(text(
+                "ALTER TABLE usage_logs ADD CONSTRAINT usage_logs_token_id_fkey "
+                "FOREIGN KEY (token_id) REFERENCES tokens (id)"
+            ))
+            await conn.execute(delete(schema_version).where(schema_version.c.version == 2))
+        await init_db(engine)
+        await delete_token_with_logs(sessions)
+
+    run(database_url, scenario)
+
+
+def test_quota_is_not_exceeded_by_concurrent_requests(database_url, monkeypatch):
+    async def scenario(engine, sessions):
+        user_id = await add_user(sessions)
+        tracker = QuotaTracker()
+        results = await asyncio.gather(*(tracker.consume(user_id, 5) for _ in range(12)))
+        assert sorted(count for count in results if count is not None) == [1, 2, 3, 4, 5]
+        # 另一个 worker（新的 QuotaTracker）看到的是同一份计数
+        assert await QuotaTracker().consume(user_id, 5) is None
+
+    run(database_url, scenario, monkeypatch)
+
+
+def test_usage_log_for_deleted_token_is_kept(database_url, monkeypatch):
+    monkeypatch.setattr(settings, "usage_max_batch_failures", 1)
+
+    async def scenario(engine, sessions):
+        user_id = await add_user(sessions)
+        writer = UsageLogWriter()
+        writer.finish(await writer.begin(user_id, "gemini-2.5-pro", token_id=12345))
+        await writer.flush()
+
+        assert (writer.written, writer.dropped) == (1, 0)
+        async with sessions() as db:
+            logs = (await db.execute(select(UsageLog.user_id, UsageLog.token_id))).all()
+            assert logs == [(user_id, None)]
+            assert await db.scalar(select(func.count(UsageLog.id))) == 1
+
+    run(database_url, scenario, monkeypatch)
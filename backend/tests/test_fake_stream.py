@@ -0,0 +1,25 @@
+import asyncio
+
+from app.config import settings
+from app.services.gemini_client import GeminiClient
+from app.services.sse import SSE_KEEPALIVE
+
+
+def test_closing_fake_stream_cancels_and_awaits_upstream(monkeypatch):
+    monkeypatch.setattr(settings, "fake_stream_heartbeat_interval", 0.01)
+    upstream = {}
+
+    async def slow_generate(payload):
+        upstream["task"] = asyncio.current_task()
+        await asyncio.sleep(10)
+
+    async def main():
+        client = GeminiClient("access", "project")
+        monkeypatch.setattr(client, "_generate", slow_generate)
+        stream = client._fake_stream("gemini-2.5-pro", [{"role": "user", "content": "hi"}])
+        assert await stream.__anext__() == SSE_KEEPALIVE
+        # 客户端断开
+        await stream.aclose()
+        assert upstream["task"].cancelled()
+
+    asyncio.run(main())
@@ -0,0 +1,21 @@
+import pytest
+
+from app.routers.public import etag_matches
+
+ETAG = '"0123456789abcdef"'
+
+
+@pytest.mark.parametrize("header", [
+    ETAG,
+    "*",
+    f"W/{ETAG}",
+    f'"other", {ETAG}',
+    f'"other",W/{ETAG} ',
+])
+def test_etag_matches(header):
+    assert etag_matches(header, ETAG)
+
+
+@pytest.mark.parametrize("header", ["", '"other"', '"other", W/"another"', "0123456789abcdef"])
+def test_etag_does_not_match(header):
+    assert not etag_matches(header, ETAG)
@@ -0,0 +1,22 @@
+from app.services.rate_limit import RateLimiter
+
+
+def drain(limiter: RateLimiter, user_id: int, rpm: int) -> int:
+    """连续请求直到被限流，返回放行的次数"""
+    allowed = 0
+    while limiter._acquire_local(user_id, rpm) == 0:
+        allowed += 1
+    return allowed
+
+
+def test_tier_change_keeps_remaining_tokens():
+    limiter = RateLimiter()
+    assert drain(limiter, 1, 10) == 10
+    # 切换到更高的档位不会得到一个新的满桶
+    assert limiter._acquire_local(1, 60) > 0
+
+
+def test_tier_change_caps_at_new_capacity():
+    limiter = RateLimiter()
+    assert limiter._acquire_local(1, 60) == 0
+    assert drain(limiter, 1, 10) == 10
@@ -0,0 +1,18 @@
+from app.services.scheduler import TokenScheduler
+
+
+def test_forget_drops_stats():
+    scheduler = TokenScheduler()
+    scheduler.acquire(1)
+    scheduler.release(1, 0.5, True)
+    scheduler.forget(1)
+    assert 1 not in scheduler._stats
+
+
+def test_release_after_forget_does_not_recreate_stats():
+    scheduler = TokenScheduler()
+    scheduler.acquire(1)
+    # 请求进行中 token 被删除
+    scheduler.forget(1)
+    scheduler.release(1, 0.5, True)
+    assert 1 not in scheduler._stats
@@ -0,0 +1,93 @@
+import json
+
+import pytest
+
+from app.services import sse
+from app.services.sse import ChatChunkEncoder
+
+
+def _stdlib_dumps(obj) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+BACKENDS = [pytest.param(_stdlib_dumps, id="json")]
+try:
+    import orjson
+
+    BACKENDS.append(pytest.param(orjson.dumps, id="orjson"))
+except ImportError:
+    pass
+
+TEXTS = [
+    "Hello",
+    "",
+    "中文和 emoji 😀",
+    'quotes " and \\ backslash',
+    "line\nbreak\ttab\r",
+    "control \x00\x1f chars",
+    "</script> & <b>",
+    "  ",
+]
+
+
+@pytest.fixture(params=BACKENDS)
+def dumps(request, monkeypatch):
+    monkeypatch.setattr(sse, "json_dumps", request.param)
+    return request.param
+
+
+def _envelope(encoder: ChatChunkEncoder, model: str, delta: dict, finish_reason):
+    """旧实现中逐块构建再序列化的 chunk 字典"""
+    return {
+        "id": encoder.id,
+        "object": "chat.completion.chunk",
+        "created": encoder.created,
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+@pytest.mark.parametrize("text", TEXTS)
+def test_delta_matches_serialized_envelope(dumps, text):
+    model = "gemini-2.5-flash"
+    encoder = ChatChunkEncoder(model)
+    expected = b"data: " + dumps(_envelope(encoder, model, {"content": text}, None)) + b"\n\n"
+    assert encoder.delta(text) == expected
+
+
+@pytest.mark.parametrize("text", TEXTS)
+def test_delta_parses_like_json_dumps(dumps, text):
+    model = "流式抗截断/gemini-2.5-pro"
+    encoder = ChatChunkEncoder(model)
+    chunk = encoder.delta(text)
+    assert chunk.startswith(b"data: ") and chunk.endswith(b"\n\n")
+    assert json.loads(chunk[6:-2]) == _envelope(encoder, model, {"content": text}, None)
+
+
+@pytest.mark.parametrize("reason", ["stop", "length", "content_filter", None])
+def test_finish_matches_serialized_envelope(dumps, reason):
+    model = 'model "quoted"'
+    encoder = ChatChunkEncoder(model)
+    expected = b"data: " + dumps(_envelope(encoder, model, {}, reason)) + b"\n\n"
+    assert encoder.finish(reason) == expected
+
+
+def test_id_and_created_are_stable_within_a_stream():
+    encoder = ChatChunkEncoder("gemini-2.5-flash")
+    chunks = [json.loads(encoder.delta(t)[6:-2]) for t in ("a", "b")]
+    chunks.append(json.loads(encoder.finish()[6:-2]))
+    assert len({(c["id"], c["created"]) for c in chunks}) == 1
+    assert chunks[0]["id"].startswith("chatcmpl-")
+
+
+def test_iter_sse_data_splits_lines_across_chunks():
+    import asyncio
+
+    async def source():
+        for piece in (b"data: {\"a\"", b":1}\r\n\r\ndata: [DONE]\n", b"\n: comment\n\ndata: tail"):
+            yield piece
+
+    async def collect():
+        return [payload async for payload in sse.iter_sse_data(source())]
+
+    assert asyncio.run(collect()) == [b'{"a":1}', b"[DONE]", b"tail"]
@@ -0,0 +1,43 @@
+import asyncio
+
+from app.services import token_pool
+from app.services.cooldown import CooldownQueue
+from app.services.token_pool import TokenPool, is_auth_failure
+
+
+RATE_LIMITED = (
+    '{"error": {"code": 429, "status": "RESOURCE_EXHAUSTED", "details": ['
+    '{"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": "4017s"}]}}'
+)
+
+
+def test_auth_failure_uses_status_code():
+    assert is_auth_failure(401, "")
+    assert is_auth_failure(403, "forbidden")
+    assert not is_auth_failure(429, RATE_LIMITED)
+    assert not is_auth_failure(500, "unauthorized")
+
+
+def test_auth_failure_falls_back_to_text():
+    assert is_auth_failure(None, "HTTP 401")
+    assert is_auth_failure(None, "Unauthorized")
+    assert not is_auth_failure(None, "timeout")
+
+
+def test_rate_limit_body_containing_401_only_parks(monkeypatch):
+    queue = CooldownQueue()
+    removed = []
+    monkeypatch.setattr(token_pool, "cooldown_queue", queue)
+    monkeypatch.setattr(token_pool.token_index, "remove", removed.append)
+
+    def no_database():
+        raise AssertionError("429 不应禁用 token")
+
+    monkeypatch.setattr(token_pool, "async_session", no_database)
+
+    asyncio.run(TokenPool.report_failure(
+        7, RATE_LIMITED, model="gemini-2.5-pro", status_code=429, retry_after=4017
+    ))
+
+    assert removed == []
+    assert queue.is_parked(7, "gemini-2.5-flash")